@@ -5,15 +5,441 @@ import re
 import time
 import urllib.parse
 import threading
+import sqlite3
+import sys
+import atexit
+import heapq
+import itertools
+import asyncio
+import functools
+import queue
+import hmac
+import http.client
+import secrets
+import signal
+import zlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from telebot import types
 
+STARTED_AT = time.perf_counter()  # Для отчёта о времени запуска
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# TELEGRAM_API_URL позволяет направить бота на локальную заглушку Bot API,
+# например http://127.0.0.1:8081/bot{0}/{1}
+if os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL')
+
 bot = telebot.TeleBot(os.getenv('BOT_TOKEN'))
 ADMIN_ID = 6337781618
+# Пул администраторов через запятую: ADMIN_IDS=111,222. Вопросы и запросы
+# переписки распределяются между ними по нагрузке
+ADMIN_IDS = [int(admin_id) for admin_id in os.getenv('ADMIN_IDS', str(ADMIN_ID)).split(',') if admin_id.strip()]
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')  # 'json' или 'sqlite'
+STORAGE_FILE = 'storage.json'
+SQLITE_FILE = 'storage.db'
+WAL_FILE = 'storage.wal'
+HISTORY_FILE = 'history.jsonl'  # История переписки хранится отдельно от снимка
+MESSAGE_HISTORY_LIMIT = 100
+ARCHIVE_DIR = 'archive'  # Обработанные вопросы старше ARCHIVE_AFTER_DAYS уходят сюда из storage
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+WAL_COMPACT_THRESHOLD = 1000  # Записей в журнале до свёртки в снимок
+# Формат снимка: json, orjson или msgpack, с '+zlib' или '+zstd' - со сжатием. При чтении определяется сам
+SNAPSHOT_CODEC = os.getenv('SNAPSHOT_CODEC', 'json')
+# Профили, нарушения и история читаются с диска только при первом обращении
+LAZY_LOAD = os.getenv('LAZY_LOAD', '1') == '1'
+SNAPSHOT_BACKUPS = int(os.getenv('SNAPSHOT_BACKUPS', '3'))  # Предыдущие снимки storage.json.1 ... .N
+PERSIST_WINDOW = float(os.getenv('PERSIST_WINDOW', '0.25'))  # Окно объединения записей, сек
+
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'polling')  # 'polling', 'sharded', 'asyncio' или 'webhook'
+ASYNC_WORKERS = int(os.getenv('ASYNC_WORKERS', '16'))
+HANDLER_SHARDS = int(os.getenv('HANDLER_SHARDS', str(os.cpu_count() or 4)))
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Внешний адрес; если пусто, webhook настроен вручную
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Если пусто, генерируется при set_webhook
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_MAX_ATTEMPTS = 5
+TELEGRAM_CHAT_INTERVAL = 1.0  # Не чаще одного сообщения в секунду в один чат
+TELEGRAM_GLOBAL_RATE = 30     # Не больше 30 сообщений в секунду всего
+
+def normalize_key(key):
+    """Приводит id, ставший строкой после JSON ('123'), обратно к int"""
+    if isinstance(key, str) and key.lstrip('-').isdigit():
+        return int(key)
+    return key
+
+def merge_duplicate(old, new):
+    """Сливает две версии записи, оказавшиеся под ключами '123' и 123"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        return {**old, **new}
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return max(old, new)
+    return new
+
+# Формат снимка
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def resolve_snapshot_codec(codec):
+    """Проверяет, что библиотеки для кодека установлены; иначе откатывается на json"""
+    name, _, compression = codec.partition('+')
+    if name not in ('json', 'orjson', 'msgpack') or compression not in ('', 'zlib', 'zstd'):
+        print(f"⚠️ Неизвестный формат снимка {codec}, используется json")
+        return 'json'
+    
+    if (name == 'orjson' and orjson is None) or (name == 'msgpack' and msgpack is None):
+        print(f"⚠️ Пакет {name} не установлен, снимок будет в json")
+        name = 'json'
+    if compression == 'zstd' and zstd is None:
+        compression = 'zlib'  # zstd есть в стандартной библиотеке только с Python 3.14
+    return name + ('+' + compression if compression else '')
+
+def encode_snapshot(data, codec):
+    """Сериализует снимок: json/orjson/msgpack, суффикс '+zlib' или '+zstd' включает сжатие"""
+    name, _, compression = codec.partition('+')
+    if name == 'msgpack':
+        payload = msgpack.packb(data, use_bin_type=True)
+    elif name == 'orjson':
+        payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    
+    if compression == 'zlib':
+        payload = zlib.compress(payload, 6)
+    elif compression == 'zstd':
+        payload = zstd.compress(payload)
+    return payload
+
+def decode_snapshot(raw, object_pairs_hook):
+    """Читает снимок любого из форматов, определяя его по первым байтам"""
+    if raw.startswith(ZSTD_MAGIC):
+        if zstd is None:
+            raise RuntimeError("снимок сжат zstd, нужен Python 3.14+")
+        raw = zstd.decompress(raw)
+    elif raw[:1] == b'\x78':
+        raw = zlib.decompress(raw)
+    
+    if raw[:1] != b'{':
+        if msgpack is None:
+            raise RuntimeError("снимок в формате msgpack, нужен пакет msgpack")
+        data = msgpack.unpackb(raw, strict_map_key=False)
+    elif orjson is not None and not raw.startswith(b'{\n'):
+        data = orjson.loads(raw)
+    else:
+        # Старые снимки с отступами могут содержать дубли '123'/123, их сливает только json с хуком
+        return json.loads(raw.decode('utf-8'), object_pairs_hook=object_pairs_hook)
+    
+    return {
+        key: object_pairs_hook(list(value.items())) if isinstance(value, dict) else value
+        for key, value in data.items()
+    }
+
+def benchmark_snapshot_codecs(sizes=(10_000, 100_000, 1_000_000)):
+    """Сравнивает форматы снимка по времени записи, чтения и размеру файла"""
+    codecs = ['json', 'json+zlib']
+    if orjson is not None:
+        codecs += ['orjson', 'orjson+zlib']
+    if msgpack is not None:
+        codecs += ['msgpack', 'msgpack+zlib']
+    if zstd is not None:
+        codecs += [codec + '+zstd' for codec in codecs if '+' not in codec]
+    
+    hook = lambda pairs: {normalize_key(key): value for key, value in pairs}
+    
+    for size in sizes:
+        questions = {
+            question_id: {
+                'id': question_id,
+                'user_id': 100000 + question_id % 5000,
+                'username': f'@user{question_id % 5000}',
+                'text': f'Вопрос номер {question_id}: как настроить https://example.com/{question_id}?',
+                'masked_text': f'Вопрос номер {question_id}: как настроить https://e••••••.com/{question_id}?',
+                'url_count': 1,
+                'time': '12:00',
+                'date': '01.01.2026',
+                'status': 'answered' if question_id % 10 else 'pending',
+                'admin_response': 'Ответ администратора' if question_id % 10 else None,
+                'created_at': '2026-01-01T12:00:00'
+            }
+            for question_id in range(size)
+        }
+        data = {'questions': questions, 'counter': size, 'wal_seq': 0}
+        
+        print(f"📦 Вопросов: {size}")
+        for codec in codecs:
+            started = time.perf_counter()
+            payload = encode_snapshot(data, codec)
+            encoded = time.perf_counter()
+            decode_snapshot(payload, hook)
+            decoded = time.perf_counter()
+            print(f"   {codec:<14} запись {encoded - started:7.3f} с | чтение {decoded - encoded:7.3f} с | "
+                  f"{len(payload) / 1024 / 1024:8.2f} МБ")
+
+SNAPSHOT_MAGIC = b'SNAPS1\n'
+
+def pack_sections(meta, sections):
+    """Собирает снимок из отдельно закодированных разделов, чтобы их можно было читать по одному"""
+    offset = 0
+    index = {}
+    for key, (payload, count) in sections.items():
+        index[key] = [offset, len(payload), zlib.crc32(payload), count]
+        offset += len(payload)
+    header = json.dumps(dict(meta, sections=index), separators=(',', ':')).encode('utf-8')
+    return SNAPSHOT_MAGIC + header + b'\n' + b''.join(payload for payload, _ in sections.values())
+
+def unpack_sections(raw):
+    """Разбирает снимок на разделы без декодирования, проверяя контрольные суммы"""
+    header_end = raw.index(b'\n', len(SNAPSHOT_MAGIC))
+    meta = json.loads(raw[len(SNAPSHOT_MAGIC):header_end])
+    body = memoryview(raw)[header_end + 1:]
+    
+    sections = {}
+    for key, (offset, length, crc, count) in meta.pop('sections').items():
+        payload = bytes(body[offset:offset + length])
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError(f"раздел {key} повреждён")
+        sections[key] = (payload, count)
+    return meta, sections
+
+class ColdCollection:
+    """Коллекция Storage, которая декодируется из снимка только при первом обращении"""
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def __get__(self, storage, owner=None):
+        if storage is None:
+            return self
+        if self.name in storage._cold:
+            storage._fault_in(self.name)
+        return storage.__dict__[self.name]
+    
+    def __set__(self, storage, value):
+        storage.__dict__[self.name] = value
+
+def write_atomic(path, payload):
+    """Записывает файл целиком или не трогает его: временный файл, fsync, rename"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    
+    # Переименование должно попасть на диск вместе с каталогом
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def trim_torn_tail(path):
+    """Обрезает недописанную последнюю строку журнала, чтобы новые записи шли с новой строки"""
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return False
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            return False
+        
+        # Ищем конец последней целой строки, читая файл с конца блоками
+        position = end
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        f.truncate(position)
+    return True
+
+def rewind_append_file(f, size):
+    """После неудачной дозаписи отрезает её остаток и открывает файл заново.
+    
+    Буфер файла отбрасывается вместе с объектом, иначе недописанные данные
+    ушли бы на диск при следующей записи.
+    """
+    fd = os.dup(f.fileno())
+    try:
+        f.close()
+    except Exception:
+        pass
+    try:
+        os.ftruncate(fd, size)
+    except OSError as e:
+        print(f"Не удалось обрезать недописанную запись: {e}")
+    return open(fd, 'a', encoding='utf-8')
+
+class HistoryEntry:
+    """Сообщение в истории переписки"""
+    __slots__ = ('id', 'text', 'time', 'is_admin')
+    
+    def __init__(self, id, text, time, is_admin):
+        self.id = id
+        self.text = text
+        self.time = time
+        self.is_admin = is_admin
+    
+    def to_dict(self):
+        return {'id': self.id, 'text': self.text, 'time': self.time, 'is_admin': self.is_admin}
+
+class MessageHistory:
+    """Кольцевой буфер последних сообщений пользователя с поиском по message_id за O(1)"""
+    __slots__ = ('capacity', '_slots', '_next', '_size', '_by_id')
+    
+    def __init__(self, capacity=MESSAGE_HISTORY_LIMIT):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._next = 0     # Слот, в который попадёт следующее сообщение
+        self._size = 0
+        self._by_id = {}   # {message_id: slot}
+    
+    def append(self, entry):
+        evicted = self._slots[self._next]
+        if evicted is not None and self._by_id.get(evicted.id) == self._next:
+            del self._by_id[evicted.id]
+        
+        self._slots[self._next] = entry
+        self._by_id[entry.id] = self._next
+        self._next = (self._next + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+    
+    def get(self, message_id):
+        slot = self._by_id.get(message_id)
+        return None if slot is None else self._slots[slot]
+    
+    def __len__(self):
+        return self._size
+    
+    def __iter__(self):
+        """Сообщения от старых к новым"""
+        start = (self._next - self._size) % self.capacity
+        for offset in range(self._size):
+            yield self._slots[(start + offset) % self.capacity]
+
+class QuestionArchive:
+    """Архив обработанных вопросов: JSONL по месяцам и индекс id -> (файл, смещение) в SQLite"""
+    
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._db = None  # Индекс открывается при первом обращении
+    
+    def _index(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.directory, 'index.db'), check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS questions '
+                '(id INTEGER PRIMARY KEY, file TEXT NOT NULL, offset INTEGER NOT NULL)'
+            )
+        return self._db
+    
+    @staticmethod
+    def _month(question):
+        created_at = question.get('created_at')
+        if created_at:
+            return created_at[:7]
+        day, month, year = question['date'].split('.')
+        return f"{year}-{month}"
+    
+    def append(self, questions):
+        """Дописывает вопросы в файлы их месяцев и только после fsync - в индекс"""
+        by_month = {}
+        for question in questions:
+            by_month.setdefault(self._month(question), []).append(question)
+        
+        rows = []
+        with self._lock:
+            db = self._index()
+            for month, items in by_month.items():
+                name = f"questions-{month}.jsonl"
+                with open(os.path.join(self.directory, name), 'ab') as f:
+                    offset = f.tell()
+                    for question in items:
+                        line = json.dumps(question, ensure_ascii=False).encode('utf-8') + b'\n'
+                        f.write(line)
+                        rows.append((question['id'], name, offset))
+                        offset += len(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            
+            with db:
+                db.executemany('INSERT OR REPLACE INTO questions (id, file, offset) VALUES (?, ?, ?)', rows)
+    
+    def get(self, question_id):
+        with self._lock:
+            row = self._index().execute(
+                'SELECT file, offset FROM questions WHERE id = ?', (question_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        
+        with open(os.path.join(self.directory, row[0]), 'rb') as f:
+            f.seek(row[1])
+            return json.loads(f.readline())
 
 # Хранилище данных
 class Storage:
-    def __init__(self):
+    # Ключ в снимке -> атрибут Storage
+    PERSISTED = {
+        'questions': 'questions',
+        'banned_users': 'banned_users',
+        'muted_users': 'muted_users',
+        'user_profiles': 'user_profiles',
+        'cooldowns': 'user_cooldowns',
+        'chat_settings': 'chat_settings',
+        'answer_counts': 'answer_counts',
+        'violation_messages': 'violation_messages',
+        'chat_limits': 'chat_limits',
+        'pending_replies': 'pending_replies',
+        'active_chats': 'active_chats',
+        'admin_pending_answers': 'admin_pending_answers',
+        'callback_tokens': 'callback_tokens',
+        'reply_routes': 'reply_routes'
+    }
+    
+    # Холодные коллекции не нужны для первого ответа и подгружаются лениво
+    user_profiles = ColdCollection()
+    violation_messages = ColdCollection()
+    message_history = ColdCollection()
+    
+    def __init__(self, lazy=LAZY_LOAD, read_only=False):
+        self.lazy = lazy
+        self.read_only = read_only  # Только чтение файлов: без потоков записи, журнала и сверки сессий
+        self._cold = {}        # {коллекция: загрузчик} для ещё не прочитанных коллекций
+        self._cold_raw = {}    # {коллекция: (закодированный раздел снимка, число записей)}
+        self._deferred = {}    # {коллекция: [записи журнала]} - применяются после загрузки
+        self._faulting = set() # Коллекции, которые сейчас загружает поток, держащий self._lock
+        
         self.questions = {}
         self.active_chats = {}
         self.banned_users = {}  # {user_id: {'until': timestamp, 'reason': str, 'notify_on_unban': bool}}
@@ -27,51 +453,483 @@ class Storage:
         self.violation_messages = {}
         self.chat_limits = {}
         self.max_active_questions = 5
-        self.user_message_counts = {}
-        self.message_history = {}
-        self.pending_replies = {}  # {user_id: {'reply_to_msg_id': int, 'reply_to_text': str}}
+        self.user_message_counts = {}  # Не используется: нужен только для чтения старых журналов
+        self.message_history = {}  # {user_id: MessageHistory}
+        self.pending_replies = {}  # {user_id: {'reply_to_msg_id': int, 'reply_to_text': str, ['user_id': int]}}
+        self.callback_tokens = {}  # {callback_data: {'action': str, 'expires': timestamp, ...}}
+        self.reply_routes = {}  # {'admin_id:message_id': {'user_id': int, 'expires': timestamp}}
+        self._versions = {}  # {коллекция: отметка последнего изменения} для кэша представлений
+        self._version_clock = itertools.count(1)
+        self.keys_merged = 0  # Сколько дублей '123'/123 слито или переписано при загрузке
+        self.corrupt_lines = 0  # Сколько повреждённых строк журнала и истории пропущено при загрузке
+        self._legacy_history = False  # История загружена из снимка старого формата и ещё не в HISTORY_FILE
+        self._snapshot_requested = False
+        self.snapshot_codec = resolve_snapshot_codec(SNAPSHOT_CODEC)
+        self.archive = QuestionArchive()
+        
+        # Журнал изменений (write-ahead log): изменения за окно PERSIST_WINDOW
+        # объединяются и записываются одной строкой JSON
+        self._lock = threading.RLock()
+        self._wal_seq = 0
+        self._wal_records = 0
+        self._wal_file = None
+        self._compact_event = threading.Event()
+        self._pending = {}  # Несохранённые записи; повторные изменения одного ключа схлопываются
+        self._pending_seq = 0
+        self._dirty_event = threading.Event()
+        self.writes_requested = 0
+        self.writes_performed = 0
+        
+        # Индексы ожидающих вопросов: обновляются при каждой смене статуса
+        self._pending_by_user = {}  # {user_id: {question_id, ...}}
+        self._pending_ids = {}      # Упорядоченное множество id ожидающих вопросов
+        self._pending_by_admin = {} # {admin_id: {question_id, ...}} - ожидающие, назначенные админу
+        self._assign_turn = itertools.count()  # Очередь при равной нагрузке админов
+        
+        # Обратный индекс сессий переписки: обновляется вместе с active_chats
+        self._chats_by_admin = {}   # {admin_id: {user_id: None}} - упорядоченное множество
+        
+        self.expiry_scheduler = None  # Получает сроки банов и мутов при их изменении
+        
+        started = time.perf_counter()
         self.load_data()
+        self._rebuild_pending_index()
+        self._rebuild_chat_index()
+        if read_only:
+            self.stale_sessions_removed = 0
+        else:
+            self._start_persistence()
+            self.stale_sessions_removed = self.reconcile_sessions()
+        self.load_time_ms = int((time.perf_counter() - started) * 1000)
     
     def load_data(self):
+        snapshot_seq = 0
+        for path in self._snapshot_candidates():
+            try:
+                with open(path, 'rb') as f:
+                    snapshot_seq = self._load_snapshot(f.read())
+            except Exception as e:
+                print(f"Ошибка загрузки снимка {path}: {e}")
+                continue
+            
+            if path != STORAGE_FILE:
+                print(f"⚠️ Основной снимок повреждён, загружен резервный {path}")
+                if os.path.exists(STORAGE_FILE) and not self.read_only:
+                    # Повреждённый снимок откладывается, чтобы ротация не вытеснила им целую копию
+                    os.replace(STORAGE_FILE, STORAGE_FILE + '.corrupt')
+            break
+        
+        # Номера снимков, для которых ещё хранятся сегменты журнала; у старых копий номер неизвестен - 0
+        backups = len(self._snapshot_candidates()) - os.path.exists(STORAGE_FILE)
+        self._snapshot_seqs = deque([0] * backups + [snapshot_seq], maxlen=SNAPSHOT_BACKUPS + 1)
+        
+        self._history_lines = 0
+        self._history_tail = None  # Строки истории, дописанные во время её свёртки
+        if self.lazy:
+            self._cold['message_history'] = self._load_history
+        else:
+            self._load_history()
+        
+        self._wal_seq = snapshot_seq
+        for path in self._wal_segments() + [WAL_FILE]:
+            self._replay_wal(path, snapshot_seq)
+        
+        if self.keys_merged:
+            # Новый снимок запишет данные уже без строковых ключей и дублей
+            self._snapshot_requested = True
+            self._compact_event.set()
+    
+    def _load_snapshot(self, raw):
+        """Разбирает снимок; возвращает номер последней вошедшей в него записи журнала"""
+        if not raw.startswith(SNAPSHOT_MAGIC):
+            # Снимок старого формата читается целиком
+            # id-ключи приводятся к int прямо при разборе, дубли '123'/123 сливаются
+            data = decode_snapshot(raw, self._id_keyed_object)
+            for snapshot_key, attr in self.PERSISTED.items():
+                setattr(self, attr, data.get(snapshot_key, {}))
+            # Снимки старого формата содержат историю внутри
+            for user_id, entries in data.get('message_history', {}).items():
+                for entry in entries:
+                    self._append_history(user_id, entry)
+                self._legacy_history = True
+            self.question_counter = data.get('counter', 1)
+            return data.get('wal_seq', 0)
+        
+        meta, sections = unpack_sections(raw)
+        loaded = {}
+        cold = {}
+        for snapshot_key, attr in self.PERSISTED.items():
+            section = sections.get(snapshot_key)
+            if section is None:
+                loaded[attr] = {}
+            elif self.lazy and isinstance(getattr(type(self), attr, None), ColdCollection):
+                cold[attr] = section
+            else:
+                loaded[attr] = decode_snapshot(section[0], self._id_keyed_object).get(snapshot_key, {})
+        
+        # Состояние меняется только после успешного разбора всех горячих разделов
+        for attr, items in loaded.items():
+            setattr(self, attr, items)
+        self._cold_raw = cold
+        for attr in cold:
+            self._cold[attr] = functools.partial(self._load_section, attr)
+        self.question_counter = meta.get('counter', 1)
+        return meta.get('wal_seq', 0)
+    
+    def _load_section(self, attr):
+        payload, _ = self._cold_raw[attr]
+        snapshot_key = next(key for key, name in self.PERSISTED.items() if name == attr)
+        setattr(self, attr, decode_snapshot(payload, self._id_keyed_object).get(snapshot_key, {}))
+        del self._cold_raw[attr]
+    
+    def _load_history(self):
+        if not os.path.exists(HISTORY_FILE):
+            return
+        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.corrupt_lines += 1
+                    continue
+                self._append_history(record['k'], record['v'])
+                self._history_lines += 1
+    
+    def _fault_in(self, attr):
+        """Загружает холодную коллекцию при первом обращении и применяет отложенные записи журнала"""
+        with self._lock:
+            loader = self._cold.get(attr)
+            if loader is None or attr in self._faulting:
+                return
+            # Коллекция остаётся в _cold до конца загрузки: читатели из других
+            # потоков видят её холодной и ждут на self._lock
+            self._faulting.add(attr)
+            try:
+                loader()
+                for record in self._deferred.get(attr, []):
+                    self._apply(record)
+                self._deferred.pop(attr, None)
+                del self._cold[attr]
+            finally:
+                self._faulting.discard(attr)
+    
+    def count_items(self, attr):
+        """Размер коллекции без её загрузки (для незагруженной - по заголовку снимка)"""
+        if attr in self._cold_raw and attr not in self._deferred:
+            return self._cold_raw[attr][1]
+        return len(getattr(self, attr))
+    
+    def _id_keyed_object(self, pairs):
+        """object_pairs_hook для json: у коллекций, где все ключи - id, ключи становятся int"""
+        if not pairs or not all(isinstance(key, str) and key.lstrip('-').isdigit() for key, _ in pairs):
+            return dict(pairs)
+        
+        items = {}
+        for key, value in pairs:
+            key = int(key)
+            if key in items:
+                value = merge_duplicate(items[key], value)
+                self.keys_merged += 1
+            items[key] = value
+        return items
+    
+    def _snapshot_candidates(self):
+        """Снимки от нового к старому: основной и резервные копии"""
+        paths = [STORAGE_FILE] + [f"{STORAGE_FILE}.{i}" for i in range(1, SNAPSHOT_BACKUPS + 1)]
+        return [path for path in paths if os.path.exists(path)]
+    
+    def _rotate_backups(self):
+        """Сдвигает резервные копии: storage.json -> .1 -> .2 ... самая старая удаляется"""
+        if not SNAPSHOT_BACKUPS:
+            return
+        for i in range(SNAPSHOT_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{STORAGE_FILE}.{i}"):
+                os.replace(f"{STORAGE_FILE}.{i}", f"{STORAGE_FILE}.{i + 1}")
+        if os.path.exists(STORAGE_FILE):
+            os.replace(STORAGE_FILE, f"{STORAGE_FILE}.1")
+    
+    def _start_persistence(self):
+        # Хвост, оборванный падением, иначе склеился бы с первой новой записью
+        trim_torn_tail(WAL_FILE)
+        trim_torn_tail(HISTORY_FILE)
+        self._wal_file = open(WAL_FILE, 'a', encoding='utf-8')
+        self._history_file = open(HISTORY_FILE, 'a', encoding='utf-8')
+        if self._legacy_history:
+            # Новые снимки хранят историю только в HISTORY_FILE: переносим её туда до первого снимка
+            self._compact_history()
+            self._legacy_history = False
+        threading.Thread(target=self._compaction_loop, daemon=True).start()
+        threading.Thread(target=self._persist_loop, daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _wal_segments(self):
+        """Возвращает свёрнутые, но ещё не удалённые сегменты журнала по порядку"""
+        directory = os.path.dirname(os.path.abspath(WAL_FILE))
+        prefix = os.path.basename(WAL_FILE) + '.'
+        segments = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                segments.append((int(name[len(prefix):]), os.path.join(directory, name)))
+        return [path for seq, path in sorted(segments)]
+    
+    def _replay_wal(self, path, snapshot_seq):
+        """Применяет записи журнала поверх загруженного снимка"""
+        if not os.path.exists(path):
+            return
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная строка после сбоя; следующие за ней записи целы
+                    self.corrupt_lines += 1
+                    continue
+                
+                if record['n'] <= snapshot_seq:
+                    continue
+                
+                for item in record.get('r', [record]):
+                    self._apply(item)
+                self._wal_seq = record['n']
+                self._wal_records += 1
+    
+    def _apply(self, record):
+        op = record['op']
+        attr = 'message_history' if op == 'hist' else record.get('c')
+        if attr in self._cold and attr not in self._faulting:
+            self._deferred.setdefault(attr, []).append(record)
+            return
+        
+        if op == 'set':
+            getattr(self, record['c'])[normalize_key(record['k'])] = record['v']
+        elif op == 'del':
+            getattr(self, record['c']).pop(normalize_key(record['k']), None)
+        elif op == 'hist':
+            self._append_history(record['k'], record['v'])
+        elif op == 'counter':
+            self.question_counter = record['v']
+    
+    def _log(self, record):
+        """Ставит запись в очередь на сохранение (O(1) независимо от объёма данных)"""
+        with self._lock:
+            if record['op'] in ('set', 'del'):
+                key = (record['c'], record['k'])
+            elif record['op'] == 'counter':
+                key = 'counter'
+            else:
+                self._pending_seq += 1
+                key = self._pending_seq
+            
+            # Переставляем ключ в конец, чтобы сохранить порядок изменений
+            self._pending.pop(key, None)
+            self._pending[key] = record
+            self.writes_requested += 1
+        
+        self._dirty_event.set()
+    
+    def _persist_loop(self):
+        while True:
+            self._dirty_event.wait()
+            time.sleep(PERSIST_WINDOW)
+            self.flush()
+    
+    def flush(self):
+        """Немедленно записывает все накопленные изменения одной операцией"""
+        with self._lock:
+            self._dirty_event.clear()
+            if not self._pending:
+                return
+            
+            batch = self._pending
+            self._pending = {}
+            
+            try:
+                self._write_batch(batch)
+                self.writes_performed += 1
+            except Exception as e:
+                print(f"Ошибка записи журнала: {e}")
+                # Незаписанное возвращается в очередь; более новые значения тех же ключей важнее
+                for key, record in self._pending.items():
+                    batch.pop(key, None)
+                    batch[key] = record
+                self._pending = batch
+                self._dirty_event.set()
+    
+    def _write_batch(self, batch):
+        """Записывает пачку; уже записанная история убирается из batch, чтобы не повторить её"""
+        history = [key for key, record in batch.items() if record['op'] == 'hist']
+        if history:
+            text = ''.join(
+                json.dumps({'k': batch[key]['k'], 'v': batch[key]['v']}, ensure_ascii=False) + '\n'
+                for key in history
+            )
+            size = self._history_file.tell()
+            try:
+                self._history_file.write(text)
+                self._history_file.flush()
+            except Exception:
+                self._history_file = rewind_append_file(self._history_file, size)
+                raise
+            if self._history_tail is not None:
+                self._history_tail.append(text)
+            self._history_lines += len(history)
+            for key in history:
+                del batch[key]
+        
+        records = list(batch.values())
+        if records:
+            line = json.dumps({'n': self._wal_seq + 1, 'r': records}, ensure_ascii=False)
+            size = self._wal_file.tell()
+            try:
+                self._wal_file.write(line + '\n')
+                self._wal_file.flush()
+            except Exception:
+                self._wal_file = rewind_append_file(self._wal_file, size)
+                raise
+            self._wal_seq += 1
+            self._wal_records += len(records)
+        
+        if self._wal_records >= WAL_COMPACT_THRESHOLD or self._history_needs_compaction():
+            self._compact_event.set()
+    
+    def _history_needs_compaction(self):
+        if 'message_history' in self._cold:
+            return False
+        # Файл истории переписывается, когда вытесненных строк в нём больше, чем живых
+        return self._history_lines > 2 * len(self.message_history) * MESSAGE_HISTORY_LIMIT + WAL_COMPACT_THRESHOLD
+    
+    def _compact_history(self):
+        """Переписывает файл истории, оставляя только сообщения из кольцевых буферов"""
+        with self._lock:
+            self.flush()
+            lines = [
+                json.dumps({'k': user_id, 'v': entry.to_dict()}, ensure_ascii=False) + '\n'
+                for user_id, history in self.message_history.items()
+                for entry in history
+            ]
+            self._history_tail = []
+        
+        # Запись и fsync - без блокировки; новые строки пока идут в старый файл и в _history_tail
         try:
-            if os.path.exists('storage.json'):
-                with open('storage.json', 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.questions = {int(k): v for k, v in data.get('questions', {}).items()}
-                    self.banned_users = data.get('banned_users', {})
-                    self.muted_users = data.get('muted_users', {})
-                    self.user_profiles = data.get('user_profiles', {})
-                    self.question_counter = data.get('counter', 1)
-                    self.user_cooldowns = data.get('cooldowns', {})
-                    self.chat_settings = data.get('chat_settings', {})
-                    self.answer_counts = data.get('answer_counts', {})
-                    self.violation_messages = data.get('violation_messages', {})
-                    self.chat_limits = data.get('chat_limits', {})
-                    self.user_message_counts = data.get('user_message_counts', {})
-                    self.message_history = data.get('message_history', {})
-                    self.pending_replies = data.get('pending_replies', {})
-        except Exception as e:
-            print(f"Ошибка загрузки данных: {e}")
+            write_atomic(HISTORY_FILE, ''.join(lines).encode('utf-8'))
+        except Exception:
+            with self._lock:
+                self._history_tail = None
+            raise
+        
+        with self._lock:
+            tail, self._history_tail = self._history_tail, None
+            self._history_file.close()
+            self._history_file = open(HISTORY_FILE, 'a', encoding='utf-8')
+            self._history_file.write(''.join(tail))
+            self._history_file.flush()
+            self._history_lines = len(lines) + sum(text.count('\n') for text in tail)
+    
+    def persistence_stats(self):
+        """Сколько записей запрошено, сколько реально записано и сколько сэкономлено"""
+        return {
+            'requested': self.writes_requested,
+            'performed': self.writes_performed,
+            'saved': self.writes_requested - self.writes_performed
+        }
+    
+    def touch(self, collection):
+        """Отмечает изменение коллекции, чтобы сбросить закэшированные представления"""
+        self._versions[collection] = next(self._version_clock)
+    
+    def version(self, collection):
+        return self._versions.get(collection, 0)
+    
+    def save_item(self, collection, key):
+        """Сохраняет текущее значение записи коллекции"""
+        with self._lock:
+            items = getattr(self, collection)
+            if normalize_key(key) != key:
+                # Строковый id переносится под int-ключ, чтобы не плодить дубли
+                value = items.pop(key)
+                key = normalize_key(key)
+                items[key] = merge_duplicate(items[key], value) if key in items else value
+            self.touch(collection)
+            self._log({'op': 'set', 'c': collection, 'k': key, 'v': items[key]})
+    
+    def remove_item(self, collection, key):
+        """Удаляет запись из коллекции и из сохранённых данных"""
+        with self._lock:
+            items = getattr(self, collection)
+            key = normalize_key(key)
+            if key in items:
+                del items[key]
+                self.touch(collection)
+                self._log({'op': 'del', 'c': collection, 'k': key})
+    
+    def save_counter(self):
+        self._log({'op': 'counter', 'v': self.question_counter})
+    
+    def next_question_id(self):
+        """Атомарно выдаёт следующий номер вопроса или запроса переписки"""
+        with self._lock:
+            question_id = self.question_counter
+            self.question_counter += 1
+            self.save_counter()
+            return question_id
+    
+    def _compaction_loop(self):
+        while True:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            
+            if self._history_needs_compaction():
+                try:
+                    self._compact_history()
+                except Exception as e:
+                    print(f"Ошибка сохранения истории: {e}")
+            if self._wal_records >= WAL_COMPACT_THRESHOLD or self._snapshot_requested:
+                self._snapshot_requested = False
+                try:
+                    self.archive_old_questions()
+                except Exception as e:
+                    print(f"Ошибка архивации вопросов: {e}")
+                self.save_data()
     
     def save_data(self):
-        data = {
-            'questions': self.questions,
-            'banned_users': self.banned_users,
-            'muted_users': self.muted_users,
-            'user_profiles': self.user_profiles,
-            'counter': self.question_counter,
-            'cooldowns': self.user_cooldowns,
-            'chat_settings': self.chat_settings,
-            'answer_counts': self.answer_counts,
-            'violation_messages': self.violation_messages,
-            'chat_limits': self.chat_limits,
-            'user_message_counts': self.user_message_counts,
-            'message_history': self.message_history,
-            'pending_replies': self.pending_replies
-        }
+        """Сворачивает журнал в новый снимок storage.json"""
+        with self._lock:
+            self.flush()
+            meta = {'counter': self.question_counter, 'wal_seq': self._wal_seq}
+            
+            try:
+                sections = {}
+                for snapshot_key, attr in self.PERSISTED.items():
+                    if attr in self._cold_raw and attr not in self._deferred:
+                        # Незагруженная и неизменённая коллекция переносится без перекодирования
+                        sections[snapshot_key] = self._cold_raw[attr]
+                    else:
+                        items = getattr(self, attr)
+                        sections[snapshot_key] = (encode_snapshot({snapshot_key: items}, self.snapshot_codec), len(items))
+                payload = pack_sections(meta, sections)
+            except Exception as e:
+                print(f"Ошибка сохранения данных: {e}")
+                return
+            
+            # Текущий журнал становится сегментом и удаляется после записи снимка
+            segment = f"{WAL_FILE}.{self._wal_seq}"
+            self._wal_file.close()
+            os.replace(WAL_FILE, segment)
+            self._wal_file = open(WAL_FILE, 'a', encoding='utf-8')
+            self._wal_records = 0
+        
+        # Запись и fsync идут в потоке свёртки, обработчики ждут только сериализацию
         try:
-            with open('storage.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self._rotate_backups()
+            write_atomic(STORAGE_FILE, payload)
+            self._snapshot_seqs.append(meta['wal_seq'])
+            
+            # Сегменты журнала нужны, пока на их основе можно восстановиться из самой старой копии
+            oldest_seq = self._snapshot_seqs[0]
+            for path in self._wal_segments():
+                if int(path.rsplit('.', 1)[1]) <= oldest_seq:
+                    os.remove(path)
         except Exception as e:
             print(f"Ошибка сохранения данных: {e}")
     
@@ -82,15 +940,13 @@ class Storage:
             'time': time_str,
             'date': date_str
         }
-        self.save_data()
+        self.save_item('violation_messages', user_id)
     
     def get_violation_message(self, user_id):
         return self.violation_messages.get(user_id)
     
     def clear_violation_message(self, user_id):
-        if user_id in self.violation_messages:
-            del self.violation_messages[user_id]
-            self.save_data()
+        self.remove_item('violation_messages', user_id)
     
     def get_answer_count(self, question_id):
         return self.answer_counts.get(question_id, 0)
@@ -98,35 +954,202 @@ class Storage:
     def increment_answer_count(self, question_id):
         current = self.get_answer_count(question_id)
         self.answer_counts[question_id] = current + 1
-        self.save_data()
+        self.save_item('answer_counts', question_id)
+    
+    def _rebuild_pending_index(self):
+        self._pending_by_user = {}
+        self._pending_ids = {}
+        self._pending_by_admin = {}
+        for question_id in sorted(self.questions):
+            self._index_question(question_id)
+    
+    def _index_question(self, question_id):
+        """Приводит индексы ожидающих вопросов в соответствие со статусом вопроса"""
+        question = self.questions[question_id]
+        user_id = question.get('user_id')
+        
+        # Назначение могло смениться при захвате: убираем вопрос у всех админов
+        for admin_id, admin_pending in list(self._pending_by_admin.items()):
+            admin_pending.discard(question_id)
+            if not admin_pending:
+                del self._pending_by_admin[admin_id]
+        
+        if question.get('status') == 'pending':
+            self._pending_ids[question_id] = None
+            self._pending_by_user.setdefault(user_id, set()).add(question_id)
+            if question.get('admin_id') is not None:
+                self._pending_by_admin.setdefault(question['admin_id'], set()).add(question_id)
+        else:
+            self._pending_ids.pop(question_id, None)
+            user_pending = self._pending_by_user.get(user_id)
+            if user_pending is not None:
+                user_pending.discard(question_id)
+                if not user_pending:
+                    del self._pending_by_user[user_id]
+    
+    def add_question(self, question):
+        """Добавляет новый вопрос или запрос переписки"""
+        with self._lock:
+            self.questions[question['id']] = question
+            self._index_question(question['id'])
+            self.save_item('questions', question['id'])
+    
+    def update_question(self, question_id, **fields):
+        """Обновляет поля вопроса (в том числе статус) и индексы"""
+        with self._lock:
+            self.questions[question_id].update(fields)
+            self._index_question(question_id)
+            self.save_item('questions', question_id)
+    
+    def get_question(self, question_id):
+        """Ищет вопрос в памяти, а затем в архиве"""
+        question = self.questions.get(question_id)
+        if question is None:
+            question = self.archive.get(question_id)
+        return question
+    
+    def archive_old_questions(self):
+        """Переносит в архив обработанные вопросы старше ARCHIVE_AFTER_DAYS; возвращает их число"""
+        cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        
+        with self._lock:
+            in_use = self._questions_in_use()
+            old = []
+            for question_id, question in self.questions.items():
+                if question.get('status') == 'pending' or question_id in in_use:
+                    continue
+                try:
+                    if 'created_at' in question:
+                        created = datetime.fromisoformat(question['created_at'])
+                    else:
+                        created = datetime.strptime(question['date'], '%d.%m.%Y')
+                except (KeyError, ValueError):
+                    continue
+                if created < cutoff:
+                    old.append(dict(question, answer_count=self.answer_counts.get(question_id, 0)))
+        
+        if not old:
+            return 0
+        
+        # Сначала архив на диске (с fsync, без блокировки), потом удаление:
+        # после сбоя вопрос окажется в обоих местах, но не потеряется
+        self.archive.append(old)
+        
+        removed = 0
+        with self._lock:
+            # Пока шла запись, к вопросу мог привязаться чат или ответ - он остаётся в памяти
+            in_use = self._questions_in_use()
+            for question in old:
+                if question['id'] in in_use or question['id'] not in self.questions:
+                    continue
+                self.remove_item('questions', question['id'])
+                self.remove_item('answer_counts', question['id'])
+                removed += 1
+        return removed
+    
+    def _questions_in_use(self):
+        """Вопросы, к которым привязаны живой чат или начатый ответ: они остаются в памяти"""
+        in_use = {chat_data.get('question_id') for chat_data in self.active_chats.values()}
+        in_use.update(self.admin_pending_answers.values())
+        return in_use
+    
+    def ensure_profile(self, user_id, username, first_name):
+        """Создаёт профиль пользователя при первом /start"""
+        with self._lock:
+            if user_id not in self.user_profiles:
+                self.user_profiles[user_id] = {
+                    'username': username,
+                    'first_name': first_name,
+                    'joined': datetime.now().isoformat(),
+                    'questions_sent': 0,
+                    'warnings': 0
+                }
+                self.save_item('user_profiles', user_id)
     
     def can_ask_question(self, user_id):
-        active_count = 0
-        for q in self.questions.values():
-            if q.get('user_id') == user_id and q.get('status') == 'pending':
-                active_count += 1
+        active_count = len(self._pending_by_user.get(user_id, ()))
         return active_count < self.max_active_questions, active_count
     
+    def get_pending_questions(self):
+        """Возвращает ожидающие ответа вопросы и запросы переписки по порядку"""
+        with self._lock:
+            return [self.questions[question_id] for question_id in self._pending_ids]
+    
+    def count_pending_questions(self):
+        return len(self._pending_ids)
+    
+    def admin_load(self, admin_id):
+        """Нагрузка админа: назначенные ему ожидающие вопросы и открытые чаты"""
+        return len(self._pending_by_admin.get(admin_id, ())) + len(self._chats_by_admin.get(admin_id, ()))
+    
+    def pick_admin(self, admin_ids):
+        """Наименее загруженный админ из пула; при равной нагрузке - по кругу"""
+        with self._lock:
+            shift = next(self._assign_turn) % len(admin_ids)
+            return min(admin_ids[shift:] + admin_ids[:shift], key=self.admin_load)
+    
+    def claim_question(self, question_id, admin_id):
+        """Закрепляет вопрос за нажавшим админом; False, если его уже взял другой"""
+        with self._lock:
+            question = self.questions.get(question_id)
+            if question is None:
+                return False
+            claimed_by = question.get('claimed_by')
+            if claimed_by is not None and claimed_by != admin_id:
+                return False
+            if claimed_by is None:
+                self.update_question(question_id, claimed_by=admin_id, admin_id=admin_id)
+            return True
+    
+    def release_claim(self, question_id, admin_id):
+        """Снимает захват вопроса админом, например после /cancel"""
+        with self._lock:
+            question = self.questions.get(question_id)
+            if question is not None and question.get('claimed_by') == admin_id:
+                self.update_question(question_id, claimed_by=None)
+    
+    # Истёкшие баны и муты снимает ExpiryScheduler, поэтому в коллекциях остаются только активные
+    def count_active_bans(self):
+        return len(self.banned_users)
+    
+    def count_active_mutes(self):
+        return len(self.muted_users)
+    
+    def _deadline_changed(self, kind, user_id, until):
+        """Сообщает планировщику о новом сроке истечения (0 - срока нет)"""
+        if self.expiry_scheduler is None:
+            return
+        
+        if until:
+            self.expiry_scheduler.schedule((kind, user_id), until)
+        else:
+            self.expiry_scheduler.cancel((kind, user_id))
+    
     def is_banned(self, user_id):
         """Проверяет, забанен ли пользователь"""
         if user_id not in self.banned_users:
             return False
         
-        ban_data = self.banned_users[user_id]
-        if ban_data.get('until') == 0:  # Перманентный бан
-            return True
-        
-        if time.time() < ban_data['until']:
-            return True
-        else:
-            # Время бана истекло, разбаниваем
-            notify = ban_data.get('notify_on_unban', True)
-            del self.banned_users[user_id]
-            self.save_data()
+        with self._lock:
+            # Запись могли снять параллельно: "expired" получает только один вызов
+            ban_data = self.banned_users.get(user_id)
+            if ban_data is None:
+                return False
             
-            if notify:
-                return "expired"  # Возвращаем специальный код для уведомления
-            return False
+            if ban_data.get('until') == 0:  # Перманентный бан
+                return True
+            
+            if time.time() < ban_data['until']:
+                return True
+            else:
+                # Время бана истекло, разбаниваем
+                notify = ban_data.get('notify_on_unban', True)
+                self.remove_item('banned_users', user_id)
+                self._deadline_changed('ban', user_id, 0)
+                
+                if notify:
+                    return "expired"  # Возвращаем специальный код для уведомления
+                return False
     
     def ban_user(self, user_id, duration_seconds=0, reason="Нарушение правил"):
         """Банит пользователя на указанное время (0 = перманентно)"""
@@ -141,13 +1164,15 @@ class Storage:
             'banned_at': time.time(),
             'notify_on_unban': duration_seconds > 0  # Уведомлять только при временном бане
         }
-        self.save_data()
+        self.save_item('banned_users', user_id)
+        self.flush()
+        self._deadline_changed('ban', user_id, until)
     
     def unban_user(self, user_id):
         """Разбанивает пользователя"""
         if user_id in self.banned_users:
-            del self.banned_users[user_id]
-            self.save_data()
+            self.remove_item('banned_users', user_id)
+            self._deadline_changed('ban', user_id, 0)
             return True
         return False
     
@@ -156,21 +1181,26 @@ class Storage:
         if user_id not in self.muted_users:
             return False
         
-        mute_data = self.muted_users[user_id]
-        if mute_data.get('until') == 0:  # Перманентный мут
-            return True
-        
-        if time.time() < mute_data['until']:
-            return True
-        else:
-            # Время мута истекло, размучиваем
-            notify = mute_data.get('notify_on_unmute', True)
-            del self.muted_users[user_id]
-            self.save_data()
+        with self._lock:
+            # Запись могли снять параллельно: "expired" получает только один вызов
+            mute_data = self.muted_users.get(user_id)
+            if mute_data is None:
+                return False
             
-            if notify:
-                return "expired"  # Возвращаем специальный код для уведомления
-            return False
+            if mute_data.get('until') == 0:  # Перманентный мут
+                return True
+            
+            if time.time() < mute_data['until']:
+                return True
+            else:
+                # Время мута истекло, размучиваем
+                notify = mute_data.get('notify_on_unmute', True)
+                self.remove_item('muted_users', user_id)
+                self._deadline_changed('mute', user_id, 0)
+                
+                if notify:
+                    return "expired"  # Возвращаем специальный код для уведомления
+                return False
     
     def mute_user(self, user_id, duration_seconds=0, reason="Нарушение правил"):
         """Мутит пользователя на указанное время (0 = перманентно)"""
@@ -185,90 +1215,711 @@ class Storage:
             'muted_at': time.time(),
             'notify_on_unmute': duration_seconds > 0  # Уведомлять только при временном муте
         }
-        self.save_data()
+        self.save_item('muted_users', user_id)
+        self.flush()
+        self._deadline_changed('mute', user_id, until)
     
     def unmute_user(self, user_id):
         """Размучивает пользователя"""
         if user_id in self.muted_users:
-            del self.muted_users[user_id]
-            self.save_data()
+            self.remove_item('muted_users', user_id)
+            self._deadline_changed('mute', user_id, 0)
             return True
         return False
     
-    def check_spam(self, user_id):
-        """Проверяет пользователя на спам"""
-        now = time.time()
-        
-        if user_id not in self.user_message_counts:
-            self.user_message_counts[user_id] = {
-                'count': 1,
-                'reset_time': now + 10
+    def add_to_message_history(self, user_id, message_id, text, is_admin=False):
+        """Добавляет сообщение в историю для функции ответа"""
+        entry = HistoryEntry(message_id, text[:200], time.time(), is_admin)
+        with self._lock:
+            self._add_history_entry(user_id, entry)
+            self._log({'op': 'hist', 'k': user_id, 'v': entry.to_dict()})
+    
+    def _add_history_entry(self, user_id, entry):
+        history = self.message_history.get(user_id)
+        if history is None:
+            history = self.message_history[user_id] = MessageHistory()
+        history.append(entry)
+    
+    def _append_history(self, user_id, data):
+        """Добавляет в историю сообщение, прочитанное с диска"""
+        self._add_history_entry(normalize_key(user_id), HistoryEntry(data['id'], data['text'], data['time'], data['is_admin']))
+    
+    def get_message_by_id(self, user_id, message_id):
+        """Находит сообщение по ID в истории"""
+        history = self.message_history.get(user_id)
+        entry = history.get(message_id) if history is not None else None
+        return entry.to_dict() if entry is not None else None
+    
+    def set_pending_reply(self, user_id, reply_to_msg_id, reply_to_text, target_user_id=None):
+        """Устанавливает ожидание ответа на сообщение"""
+        with self._lock:
+            self.pending_replies[user_id] = {
+                'reply_to_msg_id': reply_to_msg_id,
+                'reply_to_text': reply_to_text[:100]
             }
-            self.save_data()
-            return False
+            if target_user_id is not None:
+                # Админ с несколькими чатами отвечает конкретному пользователю
+                self.pending_replies[user_id]['user_id'] = target_user_id
+            self.save_item('pending_replies', user_id)
+    
+    def get_pending_reply(self, user_id):
+        """Получает информацию об ожидающем ответе"""
+        return self.pending_replies.get(user_id)
+    
+    def take_pending_reply(self, user_id):
+        """Атомарно забирает ожидающий ответ, чтобы его не использовали дважды"""
+        with self._lock:
+            pending_reply = self.pending_replies.get(user_id)
+            if pending_reply:
+                self.remove_item('pending_replies', user_id)
+            return pending_reply
+    
+    def clear_pending_reply(self, user_id):
+        """Очищает ожидание ответа"""
+        with self._lock:
+            self.remove_item('pending_replies', user_id)
+    
+    def save_callback_token(self, token, payload):
+        """Сохраняет данные кнопки; самые старые токены сверх лимита удаляются"""
+        with self._lock:
+            self.callback_tokens[token] = payload
+            self.save_item('callback_tokens', token)
+            while len(self.callback_tokens) > CALLBACK_TOKENS_LIMIT:
+                self.remove_item('callback_tokens', next(iter(self.callback_tokens)))
+    
+    def save_reply_route(self, key, route):
+        """Сохраняет маршрут ответа админа; самые старые сверх лимита удаляются"""
+        with self._lock:
+            self.reply_routes.pop(key, None)  # Обновлённый маршрут - в конец, как в LRU
+            self.reply_routes[key] = route
+            self.save_item('reply_routes', key)
+            while len(self.reply_routes) > REPLY_ROUTES_LIMIT:
+                self.remove_item('reply_routes', next(iter(self.reply_routes)))
+    
+    def _rebuild_chat_index(self):
+        self._chats_by_admin = {}
+        for user_id, chat_data in self.active_chats.items():
+            if 'admin_id' in chat_data:
+                self._chats_by_admin.setdefault(chat_data['admin_id'], {})[user_id] = None
+    
+    def _unindex_chat(self, user_id, chat_data):
+        admin_chats = self._chats_by_admin.get(chat_data.get('admin_id'))
+        if admin_chats is not None:
+            admin_chats.pop(user_id, None)
+            if not admin_chats:
+                del self._chats_by_admin[chat_data['admin_id']]
+    
+    def update_active_chat(self, user_id, **fields):
+        """Создаёт или дополняет сессию переписки; сессия с admin_id попадает в индекс админа"""
+        with self._lock:
+            chat_data = self.active_chats.setdefault(user_id, {})
+            self._unindex_chat(user_id, chat_data)
+            chat_data.update(fields)
+            if 'admin_id' in chat_data:
+                self._chats_by_admin.setdefault(chat_data['admin_id'], {})[user_id] = None
+            self.save_item('active_chats', user_id)
+    
+    def get_admin_chats(self, admin_id):
+        """Пользователи, с которыми админ сейчас переписывается, в порядке начала чатов"""
+        return list(self._chats_by_admin.get(admin_id, ()))
+    
+    def take_active_chat(self, user_id):
+        """Атомарно забирает активный чат: завершить его может только один обработчик"""
+        with self._lock:
+            chat_data = self.active_chats.get(user_id)
+            if chat_data is not None:
+                self._unindex_chat(user_id, chat_data)
+                self.remove_item('active_chats', user_id)
+            return chat_data
+    
+    def reconcile_sessions(self):
+        """Убирает после перезапуска недонастроенные чаты и осиротевшие данные; возвращает число записей"""
+        removed = 0
+        with self._lock:
+            for user_id, chat_data in list(self.active_chats.items()):
+                # Настройка чата шла через next_step_handler, который не переживает перезапуск
+                if 'admin_id' not in chat_data or user_id in self.banned_users:
+                    self.take_active_chat(user_id)
+                    removed += 1
+            
+            for collection in ('chat_settings', 'chat_limits', 'pending_replies'):
+                for user_id in list(getattr(self, collection)):
+                    if user_id not in self.active_chats and user_id not in ADMIN_IDS:
+                        self.remove_item(collection, user_id)
+                        removed += 1
+            
+            for admin_id in ADMIN_IDS:
+                if admin_id in self.pending_replies and admin_id not in self._chats_by_admin:
+                    self.remove_item('pending_replies', admin_id)
+                    removed += 1
+            
+            now = time.time()
+            for token, payload in list(self.callback_tokens.items()):
+                if payload.get('expires', 0) < now:
+                    self.remove_item('callback_tokens', token)
+                    removed += 1
+            
+            for key, route in list(self.reply_routes.items()):
+                if route.get('expires', 0) < now:
+                    self.remove_item('reply_routes', key)
+                    removed += 1
+            
+            for admin_id, question_id in list(self.admin_pending_answers.items()):
+                if self.questions.get(question_id, {}).get('status') != 'pending':
+                    self.remove_item('admin_pending_answers', admin_id)
+                    self.release_claim(question_id, admin_id)
+                    removed += 1
+        return removed
+
+class SQLiteStorage(Storage):
+    """Хранилище на встроенной SQLite: каждая мутация - одна строка в таблице"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_questions_user_status ON questions (user_id, status);
+        CREATE INDEX IF NOT EXISTS idx_questions_status ON questions (status);
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id TEXT PRIMARY KEY,
+            until REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_bans_until ON bans (until);
+        CREATE TABLE IF NOT EXISTS mutes (
+            user_id TEXT PRIMARY KEY,
+            until REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_mutes_until ON mutes (until);
+        CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_user ON history (user_id, seq);
+        CREATE TABLE IF NOT EXISTS items (
+            collection TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (collection, key)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+    
+    # Коллекции с отдельными индексируемыми таблицами
+    TIMED_TABLES = {'banned_users': 'bans', 'muted_users': 'mutes'}
+    
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        super().__init__()
+    
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(self.SCHEMA)
+        return db
+    
+    def load_data(self):
+        if not os.path.exists(self.path) and (os.path.exists(STORAGE_FILE) or os.path.exists(WAL_FILE)):
+            # Иначе бот молча начал бы с пустой базы, а баны, муты и вопросы остались бы в JSON
+            raise RuntimeError(f"{self.path} не найден, но есть данные JSON-хранилища ({STORAGE_FILE}, {WAL_FILE}). "
+                               f"Перенесите их: python main.py migrate-sqlite")
         
-        user_data = self.user_message_counts[user_id]
+        self.db = self._connect()
         
-        if now > user_data['reset_time']:
-            user_data['count'] = 1
-            user_data['reset_time'] = now + 10
-            self.save_data()
-            return False
+        try:
+            for qid, data in self.db.execute('SELECT id, data FROM questions'):
+                self.questions[qid] = json.loads(data)
+            
+            stale = []  # (коллекция, ключ в базе) для строк со строковым id
+            
+            for collection, table in self.TIMED_TABLES.items():
+                for key, data in self.db.execute(f'SELECT user_id, data FROM {table}'):
+                    self._load_item(collection, key, json.loads(data), stale)
+            
+            for key, data in self.db.execute('SELECT user_id, data FROM history ORDER BY seq'):
+                self._append_history(json.loads(key), json.loads(data))
+            
+            for collection, key, value in self.db.execute('SELECT collection, key, value FROM items'):
+                self._load_item(collection, key, json.loads(value), stale)
+            
+            if stale:
+                self._rewrite_stale_keys(stale)
+            
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'counter'").fetchone()
+            if row:
+                self.question_counter = int(row[0])
+        except Exception as e:
+            print(f"Ошибка загрузки данных: {e}")
+    
+    def _load_item(self, collection, raw_key, value, stale):
+        items = getattr(self, collection)
+        key = normalize_key(json.loads(raw_key))
+        if json.dumps(key) != raw_key:
+            stale.append((collection, raw_key))
+        items[key] = merge_duplicate(items[key], value) if key in items else value
+    
+    def _rewrite_stale_keys(self, stale):
+        """Переписывает строки со строковыми id под int-ключами одной транзакцией"""
+        with self.db:
+            for collection, raw_key in stale:
+                if collection in self.TIMED_TABLES:
+                    self.db.execute(f'DELETE FROM {self.TIMED_TABLES[collection]} WHERE user_id = ?', (raw_key,))
+                else:
+                    self.db.execute('DELETE FROM items WHERE collection = ? AND key = ?', (collection, raw_key))
+                
+                key = normalize_key(json.loads(raw_key))
+                self._write_record(self.db, {'op': 'set', 'c': collection, 'k': key,
+                                             'v': getattr(self, collection)[key]})
+                
+                self.db.execute('UPDATE history SET user_id = ? WHERE user_id = ?', (json.dumps(key), raw_key))
+        self.keys_merged += len(stale)
+    
+    def _start_persistence(self):
+        threading.Thread(target=self._persist_loop, daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _write_batch(self, batch):
+        """Применяет накопленные записи к таблицам SQLite одной транзакцией"""
+        with self.db:
+            for record in batch.values():
+                self._write_record(self.db, record)
+    
+    def _write_record(self, db, record):
+        op = record['op']
         
-        user_data['count'] += 1
-        self.save_data()
+        if op == 'counter':
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('counter', ?)",
+                       (str(record['v']),))
+            return
         
-        if user_data['count'] > 10:
-            return True
+        if op == 'hist':
+            user_key = json.dumps(record['k'])
+            db.execute('INSERT INTO history (user_id, data) VALUES (?, ?)',
+                       (user_key, json.dumps(record['v'], ensure_ascii=False)))
+            db.execute(
+                'DELETE FROM history WHERE user_id = ? AND seq <= '
+                '(SELECT seq FROM history WHERE user_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                (user_key, user_key, MESSAGE_HISTORY_LIMIT)
+            )
+            return
         
-        return False
+        collection, key = record['c'], record['k']
+        value = json.dumps(record['v'], ensure_ascii=False) if op == 'set' else None
+        
+        if collection == 'questions':
+            if op == 'set':
+                db.execute(
+                    'INSERT OR REPLACE INTO questions (id, user_id, status, data) VALUES (?, ?, ?, ?)',
+                    (key, record['v'].get('user_id'), record['v'].get('status'), value)
+                )
+            else:
+                db.execute('DELETE FROM questions WHERE id = ?', (key,))
+        elif collection in self.TIMED_TABLES:
+            table = self.TIMED_TABLES[collection]
+            if op == 'set':
+                db.execute(f'INSERT OR REPLACE INTO {table} (user_id, until, data) VALUES (?, ?, ?)',
+                           (json.dumps(key), record['v']['until'], value))
+            else:
+                db.execute(f'DELETE FROM {table} WHERE user_id = ?', (json.dumps(key),))
+        else:
+            if op == 'set':
+                db.execute('INSERT OR REPLACE INTO items (collection, key, value) VALUES (?, ?, ?)',
+                           (collection, json.dumps(key), value))
+            else:
+                db.execute('DELETE FROM items WHERE collection = ? AND key = ?',
+                           (collection, json.dumps(key)))
     
-    def add_to_message_history(self, user_id, message_id, text, is_admin=False):
-        """Добавляет сообщение в историю для функции ответа"""
-        if user_id not in self.message_history:
-            self.message_history[user_id] = []
+    def save_data(self):
+        self.flush()
+
+def wal_state():
+    """Размер и время изменения журнала - чтобы заметить записи работающего бота"""
+    try:
+        stat = os.stat(WAL_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def migrate_to_sqlite(path=SQLITE_FILE):
+    """Переносит данные JSON-хранилища в новую базу SQLite.
+    
+    Хранилище открывается только на чтение, поэтому команду можно запускать
+    рядом с работающим ботом - как пробный прогон. Записи, сделанные ботом
+    после копирования, в базу не попадут. Переключение:
+    1. python main.py migrate-sqlite - пробный перенос при работающем боте;
+    2. остановить бота (SIGTERM: накопленные записи сбрасываются на диск);
+    3. python main.py migrate-sqlite - окончательный перенос;
+    4. запустить бота с STORAGE_BACKEND=sqlite.
+    """
+    wal_before = wal_state()
+    source = Storage(lazy=False, read_only=True)
+    
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    
+    target = SQLiteStorage.__new__(SQLiteStorage)
+    target.path = tmp_path
+    db = target._connect()
+    
+    with source._lock:
+        records = [{'op': 'counter', 'v': source.question_counter}]
+        for collection in Storage.PERSISTED.values():
+            for key, value in getattr(source, collection).items():
+                records.append({'op': 'set', 'c': collection, 'k': key, 'v': value})
+        for user_id, history in source.message_history.items():
+            for entry in history:
+                records.append({'op': 'hist', 'k': user_id, 'v': entry.to_dict()})
+    
+    with db:
+        for record in records:
+            target._write_record(db, record)
+    db.close()
+    
+    os.replace(tmp_path, path)
+    print(f"✅ Перенесено записей в {path}: {len(records)}")
+    
+    if wal_state() != wal_before:
+        print("⚠️ Во время переноса бот записывал изменения. Остановите бота и повторите "
+              "migrate-sqlite перед переключением на STORAGE_BACKEND=sqlite")
+
+def benchmark_startup(sizes=(10_000, 100_000, 1_000_000)):
+    """Замеряет время загрузки хранилища и первого /start при полной и ленивой загрузке"""
+    original_dir = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                source = Storage(lazy=False)
+                for user_id in range(size):
+                    source.user_profiles[user_id] = {
+                        'username': f'@user{user_id}',
+                        'first_name': f'Пользователь {user_id}',
+                        'registered': '2026-01-01T12:00:00'
+                    }
+                for question_id in range(size // 10):
+                    source.questions[question_id] = {
+                        'id': question_id, 'user_id': question_id, 'username': f'@user{question_id}',
+                        'text': f'Вопрос {question_id}', 'time': '12:00', 'date': '01.01.2099',
+                        'status': 'pending' if question_id % 10 == 0 else 'answered',
+                        'created_at': '2099-01-01T12:00:00'
+                    }
+                source.save_data()
+                
+                print(f"📦 Профилей: {size}, вопросов: {size // 10}, снимок {os.path.getsize(STORAGE_FILE) / 1024 / 1024:.1f} МБ")
+                for lazy in (False, True):
+                    started = time.perf_counter()
+                    loaded = Storage(lazy=lazy)
+                    ready = time.perf_counter()
+                    # Работа хранилища в start_command: проверка бана и профиль пользователя
+                    loaded.is_banned(1)
+                    loaded.ensure_profile(1, '@user1', 'Пользователь 1')
+                    answered = time.perf_counter()
+                    loaded.flush()
+                    print(f"   {'ленивая' if lazy else 'полная ':<8} загрузка {(ready - started) * 1000:8.1f} мс | "
+                          f"первый /start {(answered - ready) * 1000:8.1f} мс | "
+                          f"до ответа на /start {(answered - started) * 1000:8.1f} мс")
+            finally:
+                os.chdir(original_dir)
+
+# Служебные команды из __main__: запускаются рядом с работающим ботом
+AUXILIARY_COMMANDS = ('migrate-sqlite', 'bench-ratelimit', 'bench-webhook', 'bench-urls',
+                      'bench-startup', 'bench-snapshot', 'fake-api')
+
+if sys.argv[1:2] and sys.argv[1] in AUXILIARY_COMMANDS:
+    # Им не нужно писать в хранилище, и они не должны трогать журнал и сессии бота
+    storage = Storage(lazy=True, read_only=True)
+else:
+    storage = SQLiteStorage() if STORAGE_BACKEND == 'sqlite' else Storage()
+
+# Очередь исходящих сообщений
+class OutboundQueue:
+    """Отправляет сообщения в фоне с учётом лимитов Telegram.
+    
+    Сообщения в один чат уходят строго по порядку и не чаще одного в
+    TELEGRAM_CHAT_INTERVAL секунд, всего - не больше TELEGRAM_GLOBAL_RATE
+    в секунду. На ответ 429 сообщение откладывается на retry_after.
+    """
+    
+    def __init__(self, bot, workers=OUTBOX_WORKERS, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 global_rate=TELEGRAM_GLOBAL_RATE):
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.global_rate = global_rate
         
-        self.message_history[user_id].append({
-            'id': message_id,
-            'text': text[:200],
-            'time': time.time(),
-            'is_admin': is_admin
-        })
+        self._chats = {}      # {chat_id: deque(job)} - чаты с неотправленными сообщениями
+        self._ready = []      # [(ready_at, chat_id)] - когда чат можно обслужить
+        self._last_sent = {}  # {chat_id: monotonic} - для чатов, чья очередь опустела
+        self._condition = threading.Condition()
         
-        if len(self.message_history[user_id]) > 100:
-            self.message_history[user_id] = self.message_history[user_id][-100:]
+        self._rate_lock = threading.Lock()
+        self._tokens = float(global_rate)
+        self._refill_at = time.monotonic()
         
-        self.save_data()
-    
-    def get_message_by_id(self, user_id, message_id):
-        """Находит сообщение по ID в истории"""
-        if user_id not in self.message_history:
-            return None
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
         
-        for msg in self.message_history[user_id]:
-            if msg['id'] == message_id:
-                return msg
-        return None
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
     
-    def set_pending_reply(self, user_id, reply_to_msg_id, reply_to_text):
-        """Устанавливает ожидание ответа на сообщение"""
-        self.pending_replies[user_id] = {
-            'reply_to_msg_id': reply_to_msg_id,
-            'reply_to_text': reply_to_text[:100]
+    def send(self, chat_id, text, on_sent=None, on_error=None, **kwargs):
+        """Ставит сообщение в очередь и сразу возвращает управление.
+        
+        on_sent(message) вызывается после успешной отправки,
+        on_error(exception) - если сообщение доставить не удалось.
+        """
+        self._enqueue(chat_id, None, text, on_sent, on_error, kwargs)
+    
+    def edit(self, chat_id, message_id, text, on_sent=None, on_error=None, **kwargs):
+        """Ставит в очередь редактирование уже отправленного сообщения"""
+        self._enqueue(chat_id, message_id, text, on_sent, on_error, kwargs)
+    
+    def _enqueue(self, chat_id, message_id, text, on_sent, on_error, kwargs):
+        job = {
+            'chat_id': chat_id,
+            'message_id': message_id,  # None - новое сообщение, иначе редактирование
+            'text': text,
+            'kwargs': kwargs,
+            'on_sent': on_sent,
+            'on_error': on_error,
+            'queued_at': time.monotonic(),
+            'attempts': 0
+        }
+        
+        with self._condition:
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+                ready_at = self._last_sent.pop(chat_id, 0) + self.chat_interval
+                heapq.heappush(self._ready, (max(ready_at, time.monotonic()), chat_id))
+                self._condition.notify()
+            queue.append(job)
+            self.depth += 1
+    
+    def drain(self, timeout=5):
+        """Ждёт отправки накопленных сообщений (при остановке бота)"""
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            time.sleep(0.05)
+    
+    def stats(self):
+        delivered = self.sent or 1
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'avg_latency_ms': int(self._latency_total / delivered * 1000),
+            'max_latency_ms': int(self._latency_max * 1000)
         }
-        self.save_data()
     
-    def get_pending_reply(self, user_id):
-        """Получает информацию об ожидающем ответе"""
-        return self.pending_replies.get(user_id)
+    def _acquire_global(self):
+        """Глобальный лимит: token bucket на global_rate сообщений в секунду"""
+        while True:
+            with self._rate_lock:
+                now = time.monotonic()
+                self._tokens = min(self.global_rate, self._tokens + (now - self._refill_at) * self.global_rate)
+                self._refill_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.global_rate
+            time.sleep(wait)
+    
+    def _worker(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._ready and self._ready[0][0] <= now:
+                        ready_at, chat_id = heapq.heappop(self._ready)
+                        break
+                    self._condition.wait(self._ready[0][0] - now if self._ready else None)
+                job = self._chats[chat_id].popleft()
+            
+            self._acquire_global()
+            retry_after = self._deliver(job)
+            
+            with self._condition:
+                queue = self._chats[chat_id]
+                if retry_after:
+                    queue.appendleft(job)
+                    delay = retry_after
+                else:
+                    self.depth -= 1
+                    delay = self.chat_interval
+                
+                if queue:
+                    heapq.heappush(self._ready, (time.monotonic() + delay, chat_id))
+                    self._condition.notify()
+                else:
+                    del self._chats[chat_id]
+                    self._remember_last_sent(chat_id)
+    
+    def _remember_last_sent(self, chat_id):
+        now = time.monotonic()
+        self._last_sent[chat_id] = now
+        if len(self._last_sent) > 10000:
+            self._last_sent = {
+                cid: sent_at for cid, sent_at in self._last_sent.items()
+                if now - sent_at < self.chat_interval
+            }
     
-    def clear_pending_reply(self, user_id):
-        """Очищает ожидание ответа"""
-        if user_id in self.pending_replies:
-            del self.pending_replies[user_id]
-            self.save_data()
+    def _deliver(self, job):
+        """Отправляет сообщение; возвращает паузу в секундах, если нужно повторить"""
+        job['attempts'] += 1
+        try:
+            if job['message_id'] is None:
+                sent = self.bot.send_message(job['chat_id'], job['text'], **job['kwargs'])
+            else:
+                sent = self.bot.edit_message_text(job['text'], chat_id=job['chat_id'],
+                                                  message_id=job['message_id'], **job['kwargs'])
+        except Exception as e:
+            if job['message_id'] is not None and 'message is not modified' in str(e):
+                return 0  # Повторное обновление без изменений - не ошибка
+            
+            retry_after = self._retry_after(e)
+            if retry_after and job['attempts'] < OUTBOX_MAX_ATTEMPTS:
+                self.retries += 1
+                return retry_after
+            
+            self.failed += 1
+            print(f"Ошибка отправки сообщения в {job['chat_id']}: {e}")
+            if job['on_error']:
+                self._run_callback(job['on_error'], e)
+            return 0
+        
+        latency = time.monotonic() - job['queued_at']
+        self.sent += 1
+        self._latency_total += latency
+        self._latency_max = max(self._latency_max, latency)
+        
+        if job['on_sent']:
+            self._run_callback(job['on_sent'], sent)
+        return 0
+    
+    @staticmethod
+    def _retry_after(error):
+        if getattr(error, 'error_code', None) != 429:
+            return 0
+        result = getattr(error, 'result_json', None) or {}
+        return result.get('parameters', {}).get('retry_after', 1)
+    
+    @staticmethod
+    def _run_callback(callback, arg):
+        try:
+            callback(arg)
+        except Exception as e:
+            print(f"Ошибка в обработчике отправки: {e}")
+
+class FakeBotAPI:
+    """Локальная заглушка Bot API для проверки очереди отправки.
+    
+    Отвечает на sendMessage и editMessageText; каждый too_many_every-й
+    запрос получает 429 с retry_after, как при превышении лимитов.
+    Запуск: python main.py fake-api 8081 10 2, затем бот с
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1}
+    """
+    
+    def __init__(self, host='127.0.0.1', port=8081, too_many_every=0, retry_after=1):
+        self.too_many_every = too_many_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self.calls = {}  # {method: количество успешных ответов}
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        
+        api = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                api._handle(self)
+            
+            def do_GET(self):
+                api._handle(self)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+    
+    def _handle(self, request):
+        url = urllib.parse.urlsplit(request.path)
+        method = url.path.rstrip('/').rsplit('/', 1)[-1]
+        if method not in ('sendMessage', 'editMessageText'):
+            self._reply(request, 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(request.headers.get('Content-Length', 0))
+        body = request.rfile.read(length).decode('utf-8') if length else ''
+        if body:
+            if 'json' in request.headers.get('Content-Type', ''):
+                params.update(json.loads(body))
+            else:
+                params.update(urllib.parse.parse_qsl(body))
+        
+        with self._lock:
+            self.requests += 1
+            throttle = self.too_many_every and self.requests % self.too_many_every == 0
+            if throttle:
+                self.throttled += 1
+            else:
+                self.calls[method] = self.calls.get(method, 0) + 1
+        
+        if throttle:
+            self._reply(request, 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            })
+            return
+        
+        message_id = int(params['message_id']) if params.get('message_id') else next(self._message_ids)
+        self._reply(request, 200, {'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'text': params.get('text', ''),
+        }})
+    
+    @staticmethod
+    def _reply(request, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+    
+    def serve(self):
+        print(f"🧪 Заглушка Bot API слушает {self.httpd.server_address[0]}:{self.httpd.server_address[1]} "
+              f"(429 на каждый {self.too_many_every or '-'}-й запрос, retry_after={self.retry_after})")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+        print(f"🧪 Заглушка остановлена: запросов {self.requests}, ответов 429 {self.throttled}, {self.calls}")
 
-storage = Storage()
+outbox = OutboundQueue(bot)
+atexit.register(outbox.drain)
 
 # Константы
 CHAT_MESSAGE_LIMIT = 350
@@ -279,8 +1930,324 @@ MAX_ANSWERS_PER_QUESTION = 2
 ANSWER_TIME_LIMIT_HOURS = 24
 SPAM_LIMIT_MESSAGES = 10
 SPAM_LIMIT_SECONDS = 10
+TASKS_PAGE_SIZE = 10  # Задач на одной странице /tasks
+REPLY_ROUTES_LIMIT = 10000  # Пересланных админу сообщений, на которые можно ответить
+REPLY_ROUTES_TTL = 7 * 24 * 3600  # Сколько секунд помним, от кого сообщение
+CALLBACK_TOKENS_LIMIT = 20000  # Токенов кнопок в памяти и в storage
+CALLBACK_TOKEN_TTL = 7 * 24 * 3600  # Сколько секунд работает кнопка с токеном
+
+# Лимиты антиспама: {действие: (событий, за секунд)}
+RATE_LIMIT_RULES = {
+    'message': (SPAM_LIMIT_MESSAGES, SPAM_LIMIT_SECONDS),
+    'question': (5, 60),      # Нажатия "Задать вопрос"
+    'chat_request': (5, 60)   # Нажатия "Прямая переписка"
+}
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
+class RateLimiter:
+    """Антиспам в памяти по алгоритму GCRA (эквивалент token bucket).
+    
+    На пользователя и действие хранится одно число - теоретическое время
+    следующего разрешённого события. Счётчики не сохраняются на диск;
+    простаивающие пользователи периодически вытесняются.
+    """
+    
+    def __init__(self, rules, sweep_interval=60):
+        # rules: {action: (событий, за секунд)}
+        self.rules = {
+            action: (period / limit, period - period / limit)
+            for action, (limit, period) in rules.items()
+        }
+        self.sweep_interval = sweep_interval
+        self._tat = {}  # {(user_id, action): monotonic}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+    
+    def allow(self, user_id, action='message'):
+        """Учитывает событие; False, если лимит для действия превышен"""
+        interval, tolerance = self.rules[action]
+        key = (user_id, action)
+        now = time.monotonic()
+        
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            
+            tat = max(self._tat.get(key, now), now)
+            if tat - now > tolerance:
+                return False
+            
+            self._tat[key] = tat + interval
+            return True
+    
+    def _sweep(self, now):
+        # Запись с прошедшим временем ничем не отличается от отсутствующей
+        self._tat = {key: tat for key, tat in self._tat.items() if tat > now}
+        self._next_sweep = now + self.sweep_interval
+
+rate_limiter = RateLimiter(RATE_LIMIT_RULES)
+
+def benchmark_rate_limiter(users=10_000, messages=50, threads=(1, 8)):
+    """Симулирует флуд: каждый из users пользователей шлёт messages сообщений подряд"""
+    print(f"🌊 Флуд: {users} пользователей по {messages} сообщений")
+    for workers in threads:
+        limiter = RateLimiter(RATE_LIMIT_RULES)
+        rejected = [0] * workers
+        
+        def flood(worker):
+            # Сообщения пользователей перемешаны, как в реальном потоке обновлений
+            for _ in range(messages):
+                for user_id in range(worker, users, workers):
+                    if not limiter.allow(user_id, 'message'):
+                        rejected[worker] += 1
+        
+        started = time.perf_counter()
+        pool = [threading.Thread(target=flood, args=(worker,)) for worker in range(workers)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        
+        total = users * messages
+        tracked = len(limiter._tat)
+        # Через период окна все записи простаивающих пользователей вытесняются
+        limiter._sweep(time.monotonic() + SPAM_LIMIT_SECONDS)
+        print(f"   потоков {workers}: {total / elapsed:,.0f} проверок/с, {elapsed / total * 1e6:.2f} мкс на проверку | "
+              f"отклонено {sum(rejected)} из {total} | записей {tracked}, после простоя {len(limiter._tat)}")
+
+class ReplyRoutes:
+    """Карта message_id сообщения у админа -> user_id отправителя.
+    
+    Нужна, чтобы ответ (reply) админа ушёл в нужный из параллельных чатов.
+    Размер ограничен: лишние записи вытесняются по LRU, старые - по TTL.
+    Копия лежит в storage, чтобы после рестарта ответы в восстановленные
+    параллельные чаты по-прежнему находили адресата.
+    """
+    
+    def __init__(self, limit=REPLY_ROUTES_LIMIT, ttl=REPLY_ROUTES_TTL):
+        self.limit = limit
+        self.ttl = ttl
+        self._routes = OrderedDict()  # {(admin_id, message_id): (user_id, monotonic)}
+        self._lock = threading.Lock()
+    
+    def add(self, admin_id, message_id, user_id):
+        """Запоминает, от какого пользователя пересланное сообщение"""
+        key = (admin_id, message_id)  # message_id уникален только в пределах чата
+        self._remember(key, user_id, time.monotonic())
+        storage.save_reply_route(f'{admin_id}:{message_id}',
+                                 {'user_id': user_id, 'expires': time.time() + self.ttl})
+    
+    def _remember(self, key, user_id, added_at):
+        with self._lock:
+            self._routes[key] = (user_id, added_at)
+            self._routes.move_to_end(key)
+            while len(self._routes) > self.limit:
+                self._routes.popitem(last=False)
+    
+    def get(self, admin_id, message_id):
+        """Возвращает user_id по message_id в чате админа или None"""
+        key = (admin_id, message_id)
+        with self._lock:
+            route = self._routes.get(key)
+        
+        if route is None:
+            # После перезапуска или вытеснения из памяти - берём копию из storage
+            stored = storage.reply_routes.get(f'{admin_id}:{message_id}')
+            if stored is None:
+                return None
+            # Срок в storage - по часам, в памяти - по monotonic
+            route = (stored['user_id'], time.monotonic() - self.ttl + (stored['expires'] - time.time()))
+            self._remember(key, *route)
+        
+        user_id, added_at = route
+        with self._lock:
+            # Между блокировками запись могли вытеснить
+            if time.monotonic() - added_at > self.ttl:
+                self._routes.pop(key, None)
+                return None
+            if key in self._routes:
+                self._routes.move_to_end(key)
+            return user_id
+    
+    def __len__(self):
+        return len(self._routes)
+
+reply_routes = ReplyRoutes()
+
+class CallbackRegistry:
+    """Короткие токены для callback_data вместо текста сообщения в кнопке.
+    
+    Telegram ограничивает callback_data 64 байтами, а кириллица занимает по
+    два байта на символ. Кнопка получает токен вида 't:xxxxxxxx', данные лежат
+    в памяти (LRU + TTL) и копией в storage, чтобы кнопки пережили перезапуск.
+    """
+    
+    PREFIX = 't:'
+    
+    def __init__(self, limit=CALLBACK_TOKENS_LIMIT, ttl=CALLBACK_TOKEN_TTL):
+        self.limit = limit
+        self.ttl = ttl
+        self._payloads = OrderedDict()  # {callback_data: payload}
+        self._lock = threading.Lock()
+    
+    def issue(self, action, **fields):
+        """Возвращает callback_data для кнопки с действием action и данными fields"""
+        token = self.PREFIX + secrets.token_urlsafe(6)
+        payload = dict(fields, action=action, expires=time.time() + self.ttl)
+        self._remember(token, payload)
+        storage.save_callback_token(token, payload)
+        return token
+    
+    def resolve(self, data):
+        """Данные кнопки по callback_data или None, если токен неизвестен или истёк"""
+        with self._lock:
+            payload = self._payloads.get(data)
+            if payload is not None:
+                self._payloads.move_to_end(data)
+        
+        if payload is None:
+            # После перезапуска или вытеснения из памяти - берём копию из storage
+            payload = storage.callback_tokens.get(data)
+            if payload is None:
+                return None
+            self._remember(data, payload)
+        
+        if payload['expires'] < time.time():
+            return None
+        return payload
+    
+    def _remember(self, token, payload):
+        with self._lock:
+            self._payloads[token] = payload
+            self._payloads.move_to_end(token)
+            while len(self._payloads) > self.limit:
+                self._payloads.popitem(last=False)
+
+callback_registry = CallbackRegistry()
+
+class Router:
+    """Таблица маршрутов: действие -> обработчик, со временем обработки.
+    
+    Ключ имеет вид '<действие>_<аргумент>_<аргумент>'. Действие ищется в
+    словаре от самого длинного префикса из частей через '_', поэтому
+    'ban_user_5' не попадёт в 'ban', а число проверок ограничено длиной
+    самого длинного действия. Аргументы разбираются один раз по
+    преобразователям, указанным при регистрации.
+    """
+    
+    def __init__(self):
+        self._routes = {}  # {действие: (обработчик, преобразователи аргументов)}
+        self._depth = 1    # Частей в самом длинном действии
+        self._stats = {}   # {действие: [вызовов, суммарно сек, максимум сек]}
+        self._lock = threading.Lock()
+    
+    def route(self, action, *converters):
+        """Декоратор: регистрирует обработчик действия"""
+        def register(handler):
+            self._routes[action] = (handler, converters)
+            self._depth = max(self._depth, action.count('_') + 1)
+            self._stats[action] = [0, 0.0, 0.0]
+            return handler
+        return register
+    
+    def match(self, key):
+        """Находит маршрут: (действие, аргументы) или None"""
+        parts = key.split('_', self._depth)
+        for size in range(min(self._depth, len(parts)), 0, -1):
+            action = '_'.join(parts[:size])
+            route = self._routes.get(action)
+            if route is None:
+                continue
+            
+            converters = route[1]
+            rest = key[len(action) + 1:]
+            if not converters:
+                if rest:
+                    continue
+                return action, ()
+            
+            values = rest.split('_', len(converters) - 1)
+            if len(values) != len(converters):
+                return None
+            try:
+                return action, tuple(convert(value) for convert, value in zip(converters, values))
+            except ValueError:
+                return None
+        return None
+    
+    def dispatch(self, key, *context):
+        """Вызывает обработчик по ключу; False, если маршрута нет"""
+        found = self.match(key)
+        if found is None:
+            return False
+        action, args = found
+        self.call(action, *context, *args)
+        return True
+    
+    def call(self, action, *args, **kwargs):
+        """Вызывает обработчик действия напрямую и учитывает время"""
+        handler = self._routes[action][0]
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                stats = self._stats[action]
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+    
+    def __contains__(self, action):
+        return action in self._routes
+    
+    def stats(self):
+        """Маршруты с числом вызовов и временем обработки, мс"""
+        with self._lock:
+            return [
+                {
+                    'action': action,
+                    'calls': calls,
+                    'avg_ms': round(total / calls * 1000, 2) if calls else 0.0,
+                    'max_ms': round(peak * 1000, 2)
+                }
+                for action, (calls, total, peak) in self._stats.items()
+            ]
+
+callback_router = Router()  # callback_data inline-кнопок
+token_actions = Router()    # Действия кнопок с токеном реестра: данные не из callback_data
+admin_buttons = Router()    # Кнопки клавиатуры админа
+
+def forwarded_to_admin(admin_id, user_id, text):
+    """Колбэк отправки админу: пишет историю и запоминает маршрут ответа"""
+    def on_sent(sent):
+        storage.add_to_message_history(admin_id, sent.message_id, text, is_admin=False)
+        reply_routes.add(admin_id, sent.message_id, user_id)
+    return on_sent
+
+def resolve_admin_chat(message):
+    """Определяет чат, которому адресовано сообщение админа"""
+    admin_id = message.from_user.id
+    chats = storage.get_admin_chats(admin_id)
+    
+    # Ответ (reply) на пересланное сообщение однозначно указывает пользователя
+    reply = getattr(message, 'reply_to_message', None)
+    if reply is not None:
+        user_id = reply_routes.get(admin_id, reply.message_id)
+        if user_id in chats:
+            return user_id
+    
+    if len(chats) == 1:
+        return chats[0]
+    if chats:
+        outbox.send(
+            admin_id,
+            f"↪️ Открыто чатов: {len(chats)}. Ответьте (reply) на сообщение "
+            f"пользователя, чтобы выбрать, кому пишете."
+        )
+    return None
+
 def escape_markdown(text):
     """Экранирует специальные символы Markdown"""
     if not text:
@@ -329,48 +2296,43 @@ def mask_url(url):
         print(f"Ошибка маскировки URL {url}: {e}")
         return url
 
-def find_and_mask_urls(text):
-    """Находит и маскирует все URL в тексте"""
-    url_pattern = r'(?i)(https?://[^\s<>"]+|www\.[^\s<>"]+\.[^\s<>"]+)'
-    urls = re.findall(url_pattern, text)
-    
-    if not urls:
-        return text, 0
-    
-    masked_text = text
-    for url in urls:
-        normalized_url = url
-        if not url.lower().startswith(('http://', 'https://', 'www.')):
-            normalized_url = 'http://' + url
-        
-        masked_url = mask_url(normalized_url)
-        
-        if not url.lower().startswith(('http://', 'https://')):
-            if masked_url.startswith('http://'):
-                masked_url = masked_url[7:]
-            elif masked_url.startswith('https://'):
-                masked_url = masked_url[8:]
-        
-        masked_text = masked_text.replace(url, masked_url)
-    
-    return masked_text, len(urls)
+URL_PATTERN = re.compile(r'(?i)https?://[^\s<>"]+|www\.[^\s<>"]+\.[^\s<>"]+')
 
-def find_all_urls(text):
-    """Находит все URL в тексте (возвращает список)"""
-    url_pattern = r'(?i)(https?://[^\s<>"]+|www\.[^\s<>"]+\.[^\s<>"]+)'
-    urls = re.findall(url_pattern, text)
-    
+def decode_url(url):
+    """Раскодирует URL и добавляет протокол, если его нет"""
+    try:
+        decoded = urllib.parse.unquote(url)
+        if not decoded.lower().startswith(('http://', 'https://')):
+            decoded = 'http://' + decoded
+        return decoded
+    except Exception:
+        return url
+
+def scan_urls(text):
+    """Находит все URL за один проход: возвращает позиции, раскодированные ссылки и замаскированный текст"""
+    spans = []
     decoded_urls = []
-    for url in urls:
-        try:
-            decoded = urllib.parse.unquote(url)
-            if not decoded.lower().startswith(('http://', 'https://')):
-                decoded = 'http://' + decoded
-            decoded_urls.append(decoded)
-        except:
-            decoded_urls.append(url)
     
-    return decoded_urls
+    def replace(match):
+        url = match.group(0)
+        spans.append(match.span())
+        decoded_urls.append(decode_url(url))
+        return mask_url(url)
+    
+    masked_text = URL_PATTERN.sub(replace, text)
+    return spans, decoded_urls, masked_text
+
+def benchmark_urls(iterations=200):
+    """Замеряет скорость поиска и маскировки ссылок на длинных сообщениях"""
+    text = ' '.join(
+        f'текст https://site{i}.example.com/path?q={i}%20x и www.mirror{i}.org/page' for i in range(200)
+    )
+    started = time.perf_counter()
+    for _ in range(iterations):
+        spans, _, _ = scan_urls(text)
+    elapsed = time.perf_counter() - started
+    print(f"📏 Длина сообщения: {len(text)} символов, ссылок: {len(spans)}")
+    print(f"⏱ scan_urls: {elapsed / iterations * 1000:.3f} мс на сообщение")
 
 def parse_duration(duration_str):
     """Парсит строку длительности в секунды"""
@@ -447,47 +2409,118 @@ def format_duration(seconds):
     
     return " ".join(result)
 
-def check_ban_expirations():
-    """Проверяет истекшие баны и отправляет уведомления"""
-    while True:
-        try:
-            current_time = time.time()
-            
-            # Проверяем баны
-            for user_id, ban_data in list(storage.banned_users.items()):
-                if ban_data['until'] != 0 and current_time >= ban_data['until']:
-                    if storage.is_banned(user_id) == "expired":
-                        try:
-                            bot.send_message(
-                                user_id,
-                                f"✅ *Ваш бан истек!*\n\n"
-                                f"Вы снова можете пользоваться ботом.\n"
-                                f"Причина бана: {ban_data['reason']}"
-                            )
-                        except:
-                            pass
-            
-            # Проверяем муты
-            for user_id, mute_data in list(storage.muted_users.items()):
-                if mute_data['until'] != 0 and current_time >= mute_data['until']:
-                    if storage.is_muted(user_id) == "expired":
-                        try:
-                            bot.send_message(
-                                user_id,
-                                f"✅ *Ваш мут истек!*\n\n"
-                                f"Вы снова можете использовать прямую переписку.\n"
-                                f"Причина мута: {mute_data['reason']}"
-                            )
-                        except:
-                            pass
+class ExpiryScheduler:
+    """Планировщик истечения банов и мутов: спит ровно до ближайшего срока"""
+    
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self._heap = []       # [(until, key)], устаревшие записи пропускаются при извлечении
+        self._deadlines = {}  # {key: until} - актуальные сроки
+        self._condition = threading.Condition()
+    
+    def schedule(self, key, until):
+        """Ставит или переносит срок истечения для ключа ('ban'|'mute', user_id)"""
+        with self._condition:
+            self._deadlines[key] = until
+            heapq.heappush(self._heap, (until, key))
+            self._condition.notify()
+    
+    def cancel(self, key):
+        with self._condition:
+            self._deadlines.pop(key, None)
+    
+    def rebuild(self):
+        """Восстанавливает расписание из сохранённых банов и мутов"""
+        for user_id, ban_data in list(storage.banned_users.items()):
+            if ban_data['until'] != 0:
+                self.schedule(('ban', user_id), ban_data['until'])
+        
+        for user_id, mute_data in list(storage.muted_users.items()):
+            if mute_data['until'] != 0:
+                self.schedule(('mute', user_id), mute_data['until'])
+    
+    def start(self):
+        self.rebuild()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    # Отбрасываем отменённые и перенесённые сроки
+                    while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                
+                until, key = heapq.heappop(self._heap)
+                del self._deadlines[key]
             
-            time.sleep(60)  # Проверяем каждую минуту
-        except Exception as e:
-            print(f"Ошибка в check_ban_expirations: {e}")
-            time.sleep(60)
+            try:
+                self.on_expire(key)
+            except Exception as e:
+                print(f"Ошибка в ExpiryScheduler: {e}")
+
+def notify_expiration(key):
+    """Снимает истекший бан или мут и уведомляет пользователя"""
+    kind, user_id = key
+    
+    if kind == 'ban':
+        ban_data = storage.banned_users.get(user_id)
+        if ban_data and storage.is_banned(user_id) == "expired":
+            outbox.send(
+                user_id,
+                f"✅ *Ваш бан истек!*\n\n"
+                f"Вы снова можете пользоваться ботом.\n"
+                f"Причина бана: {ban_data['reason']}"
+            )
+    
+    elif kind == 'mute':
+        mute_data = storage.muted_users.get(user_id)
+        if mute_data and storage.is_muted(user_id) == "expired":
+            outbox.send(
+                user_id,
+                f"✅ *Ваш мут истек!*\n\n"
+                f"Вы снова можете использовать прямую переписку.\n"
+                f"Причина мута: {mute_data['reason']}"
+            )
+
+expiry_scheduler = ExpiryScheduler(notify_expiration)
+storage.expiry_scheduler = expiry_scheduler
+
+class ViewCache:
+    """Кэш отрисованных админских представлений, сбрасывается при изменении нужных коллекций"""
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self._views = {}  # {имя: (версии коллекций, значение)}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, name, collections, render):
+        # Версии читаются до отрисовки: изменение во время render() сбросит кэш в следующий раз
+        versions = tuple(self.storage.version(collection) for collection in collections)
+        cached = self._views.get(name)
+        if cached is not None and cached[0] == versions:
+            self.hits += 1
+            return cached[1]
+        
+        self.misses += 1
+        value = render()
+        self._views[name] = (versions, value)
+        return value
+
+view_cache = ViewCache(storage)
 
 def is_admin(user_id):
-    return user_id == ADMIN_ID
+    return user_id in ADMIN_IDS
 
 def is_user_in_chat(user_id):
     return user_id in storage.active_chats
@@ -519,7 +2552,7 @@ def set_cooldown(user_id, action_type):
         storage.user_cooldowns[user_id] = {}
     
     storage.user_cooldowns[user_id][action_type] = time.time()
-    storage.save_data()
+    storage.save_item('user_cooldowns', user_id)
 
 def can_answer_question(question_id):
     """Проверяет, можно ли отвечать на вопрос"""
@@ -561,7 +2594,7 @@ def start_command(message):
             else:
                 ban_time = "истёк"
         
-        bot.send_message(
+        outbox.send(
             user_id, 
             f"🚫 Вы заблокированы администратором.\n"
             f"Причина: {ban_data['reason']}\n"
@@ -574,24 +2607,16 @@ def start_command(message):
         return
     
     # Проверка на спам
-    if storage.check_spam(user_id):
+    if not rate_limiter.allow(user_id, 'message'):
         storage.ban_user(user_id, 3600, "Спам (более 10 сообщений за 10 секунд)")
-        bot.send_message(
+        outbox.send(
             user_id,
             "🚫 Вы были заблокированы за спам на 1 час."
         )
         return
     
     username = f"@{message.from_user.username}" if message.from_user.username else message.from_user.first_name
-    if user_id not in storage.user_profiles:
-        storage.user_profiles[user_id] = {
-            'username': username,
-            'first_name': message.from_user.first_name,
-            'joined': datetime.now().isoformat(),
-            'questions_sent': 0,
-            'warnings': 0
-        }
-        storage.save_data()
+    storage.ensure_profile(user_id, username, message.from_user.first_name)
     
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     markup.add(
@@ -600,7 +2625,7 @@ def start_command(message):
         types.KeyboardButton('ℹ️ Помощь')
     )
     
-    bot.send_message(
+    outbox.send(
         user_id,
         f"👋 Привет, {message.from_user.first_name}!\n\nВыберите действие:",
         reply_markup=markup
@@ -632,7 +2657,7 @@ def show_user_help(message):
         "• /stop - завершить переписку\n"
         "• За спам - блокировка"
     )
-    bot.send_message(message.chat.id, help_text, parse_mode='Markdown')
+    outbox.send(message.chat.id, help_text, parse_mode='Markdown')
 
 def show_admin_help(message):
     help_text = (
@@ -644,9 +2669,10 @@ def show_admin_help(message):
         "• /unban [ID] - Разбанить\n"
         "• /mute [ID] [время] [причина] - Заглушить (запретить переписку)\n"
         "• /unmute [ID] - Разглушить\n"
-        "• /stop [причина] - Завершить текущий чат с причиной\n"
+        "• /stop [причина] - Завершить текущий чат с причиной (при нескольких - ответом на сообщение пользователя)\n"
         "• /message [ID] текст - Отправить сообщение\n"
-        "• /full - Раскрыть ссылку в вопросе\n\n"
+        "• /full - Раскрыть ссылку в вопросе\n"
+        "• /routes - Маршруты кнопок и время их обработки\n\n"
         
         "*Бан с указанием времени:*\n"
         "`/ban 123456789` - навсегда\n"
@@ -682,7 +2708,7 @@ def show_admin_help(message):
         f"• У пользователя максимум {storage.max_active_questions} активных вопросов\n"
         f"• Антиспам: более {SPAM_LIMIT_MESSAGES} сообщений за {SPAM_LIMIT_SECONDS} секунд = бан"
     )
-    bot.send_message(ADMIN_ID, help_text, parse_mode='Markdown')
+    outbox.send(message.chat.id, help_text, parse_mode='Markdown')
 
 @bot.message_handler(commands=['cancel'])
 def cancel_command(message):
@@ -690,14 +2716,17 @@ def cancel_command(message):
     
     if is_user_in_chat(user_id):
         end_chat(user_id, "user_used_command")
-        bot.send_message(user_id, "❌ Диалог завершен, так как вы использовали команду.")
+        outbox.send(user_id, "❌ Диалог завершен, так как вы использовали команду.")
         return
     
-    if user_id == ADMIN_ID and user_id in storage.admin_pending_answers:
-        del storage.admin_pending_answers[user_id]
-        bot.send_message(ADMIN_ID, "✅ Ответ отменен.")
+    if is_admin(user_id) and user_id in storage.admin_pending_answers:
+        question_id = storage.admin_pending_answers[user_id]
+        storage.remove_item('admin_pending_answers', user_id)
+        # Вопрос снова может взять любой админ
+        storage.release_claim(question_id, user_id)
+        outbox.send(user_id, "✅ Ответ отменен.")
     
-    bot.send_message(user_id, "✅ Действие отменено.")
+    outbox.send(user_id, "✅ Действие отменено.")
     start_command(message)
 
 @bot.message_handler(commands=['stop'])
@@ -712,21 +2741,20 @@ def stop_command(message):
         
         if is_user_in_chat(user_id):
             end_chat(user_id, "user_stop")
-            bot.send_message(user_id, "⏹ Вы завершили переписку.")
+            outbox.send(user_id, "⏹ Вы завершили переписку.")
             return
         
-        bot.send_message(user_id, "❌ Вы не находитесь в активной переписке.")
+        outbox.send(user_id, "❌ Вы не находитесь в активной переписке.")
         return
     
     # Для админа - новая логика с причиной
-    active_user_id = None
-    for uid, chat_data in storage.active_chats.items():
-        if chat_data['admin_id'] == ADMIN_ID:
-            active_user_id = uid
-            break
+    if not storage.get_admin_chats(user_id):
+        outbox.send(user_id, "❌ Нет активных чатов")
+        return
     
+    # При нескольких чатах /stop отправляется ответом на сообщение пользователя
+    active_user_id = resolve_admin_chat(message)
     if not active_user_id:
-        bot.send_message(ADMIN_ID, "❌ Нет активных чатов")
         return
     
     # Извлекаем причину из сообщения
@@ -736,16 +2764,16 @@ def stop_command(message):
     if reason:
         # Завершаем чат с причиной
         end_chat_with_reason(active_user_id, reason)
-        bot.send_message(ADMIN_ID, f"✅ Чат завершен с причиной: {reason}")
+        outbox.send(user_id, f"✅ Чат завершен с причиной: {reason}")
     else:
         # Завершаем чат без причины
         end_chat(active_user_id, "admin_stop")
-        bot.send_message(ADMIN_ID, "✅ Чат завершен")
+        outbox.send(user_id, "✅ Чат завершен")
 
 def end_chat(user_id, reason="normal"):
     """Завершает чат без указания причины"""
-    if user_id in storage.active_chats:
-        chat_data = storage.active_chats[user_id]
+    chat_data = storage.take_active_chat(user_id)
+    if chat_data:
         user_name = chat_data['user_name']
         admin_id = chat_data['admin_id']
         
@@ -762,96 +2790,76 @@ def end_chat(user_id, reason="normal"):
         
         message_text = messages.get(reason, "⏹ Чат завершен")
         
-        try:
-            bot.send_message(admin_id, f"{message_text} с {user_name}")
-        except:
-            pass
+        outbox.send(admin_id, f"{message_text} с {user_name}")
         
         if reason not in ["ban", "mute"] and storage.is_banned(user_id) is not True:
             try:
                 if reason == "admin_stop":
-                    bot.send_message(user_id, "⏹ Администратор завершил переписку.")
+                    outbox.send(user_id, "⏹ Администратор завершил переписку.")
                 elif reason == "user_stop":
-                    bot.send_message(user_id, "⏹ Вы завершили переписку.")
+                    outbox.send(user_id, "⏹ Вы завершили переписку.")
                 elif reason == "link_sent":
-                    bot.send_message(user_id, "⏹ Переписка завершена. Отправка ссылок запрещена.")
+                    outbox.send(user_id, "⏹ Переписка завершена. Отправка ссылок запрещена.")
                 elif reason == "admin_cancelled":
-                    bot.send_message(user_id, "⏹ Администратор отклонил создание переписки.")
+                    outbox.send(user_id, "⏹ Администратор отклонил создание переписки.")
                 else:
-                    bot.send_message(user_id, "⏹ Переписка завершена.")
+                    outbox.send(user_id, "⏹ Переписка завершена.")
             except:
                 pass
         
-        del storage.active_chats[user_id]
-        if user_id in storage.chat_settings:
-            del storage.chat_settings[user_id]
-        if user_id in storage.chat_limits:
-            del storage.chat_limits[user_id]
-        if user_id in storage.pending_replies:
-            del storage.pending_replies[user_id]
-        
-        storage.save_data()
+        storage.remove_item('chat_settings', user_id)
+        storage.remove_item('chat_limits', user_id)
+        storage.remove_item('pending_replies', user_id)
 
 def end_chat_with_reason(user_id, reason):
     """Завершает чат с указанием причины"""
-    if user_id in storage.active_chats:
-        chat_data = storage.active_chats[user_id]
+    chat_data = storage.take_active_chat(user_id)
+    if chat_data:
         user_name = chat_data['user_name']
         admin_id = chat_data['admin_id']
         
         # Уведомляем админа
-        try:
-            bot.send_message(admin_id, f"⏹ Чат завершен с {user_name}\nПричина: {reason}")
-        except:
-            pass
+        outbox.send(admin_id, f"⏹ Чат завершен с {user_name}\nПричина: {reason}")
         
         # Уведомляем пользователя
         if storage.is_banned(user_id) is not True:
-            try:
-                bot.send_message(user_id, f"⏹ Администратор завершил переписку.\nПричина: {reason}")
-            except:
-                pass
-        
-        del storage.active_chats[user_id]
-        if user_id in storage.chat_settings:
-            del storage.chat_settings[user_id]
-        if user_id in storage.chat_limits:
-            del storage.chat_limits[user_id]
-        if user_id in storage.pending_replies:
-            del storage.pending_replies[user_id]
+            outbox.send(user_id, f"⏹ Администратор завершил переписку.\nПричина: {reason}")
         
-        storage.save_data()
+        storage.remove_item('chat_settings', user_id)
+        storage.remove_item('chat_limits', user_id)
+        storage.remove_item('pending_replies', user_id)
 
 @bot.message_handler(commands=['admin'])
 def admin_command(message):
     if not is_admin(message.from_user.id):
-        bot.send_message(message.chat.id, "⛔ У вас нет доступа к этой команде")
+        outbox.send(message.chat.id, "⛔ У вас нет доступа к этой команде")
         return
     
     admin_panel(message)
 
+@admin_buttons.route('🔄 Обновить')
 def admin_panel(message):
-    pending_count = len([q for q in storage.questions.values() if q.get('status') == 'pending'])
-    
-    active_bans = 0
-    for user_id, ban_data in storage.banned_users.items():
-        if ban_data['until'] == 0 or time.time() < ban_data['until']:
-            active_bans += 1
-    
-    active_mutes = 0
-    for user_id, mute_data in storage.muted_users.items():
-        if mute_data['until'] == 0 or time.time() < mute_data['until']:
-            active_mutes += 1
+    pending_count = storage.count_pending_questions()
+    active_bans = storage.count_active_bans()
+    active_mutes = storage.count_active_mutes()
+    persist_stats = storage.persistence_stats()
+    outbox_stats = outbox.stats()
     
     text = (
         f"👑 *Панель администратора*\n\n"
         f"📊 Статистика:\n"
         f"• Вопросов: {pending_count}\n"
         f"• Чатов: {len(storage.active_chats)}\n"
-        f"• Пользователей: {len(storage.user_profiles)}\n"
+        f"• Ваша нагрузка: {storage.admin_load(message.chat.id)} (вопросы и чаты)\n"
+        f"• Пользователей: {storage.count_items('user_profiles')}\n"
         f"• Активных банов: {active_bans}\n"
         f"• Активных мутов: {active_mutes}\n"
-        f"• Нарушений ссылок: {len(storage.violation_messages)}\n\n"
+        f"• Нарушений ссылок: {storage.count_items('violation_messages')}\n"
+        f"• Записей на диск: {persist_stats['performed']} из {persist_stats['requested']} "
+        f"(сэкономлено {persist_stats['saved']})\n"
+        f"• Очередь отправки: {outbox_stats['depth']} "
+        f"(задержка {outbox_stats['avg_latency_ms']}/{outbox_stats['max_latency_ms']} мс)\n"
+        f"• Кэш представлений: {view_cache.hits} попаданий, {view_cache.misses} промахов\n\n"
         f"🕐 {datetime.now().strftime('%H:%M:%S')}"
     )
     
@@ -864,7 +2872,18 @@ def admin_panel(message):
         types.KeyboardButton('🔄 Обновить')
     )
     
-    bot.send_message(ADMIN_ID, text, parse_mode='Markdown', reply_markup=markup)
+    outbox.send(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
+
+@bot.message_handler(commands=['routes'])
+def routes_command(message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    text = "🧭 *Маршруты:*\n\n"
+    for router in (callback_router, token_actions, admin_buttons):
+        for route in sorted(router.stats(), key=lambda route: route['avg_ms'], reverse=True):
+            text += f"`{route['action']}` - {route['calls']} выз., ср. {route['avg_ms']} мс, макс. {route['max_ms']} мс\n"
+    outbox.send(message.chat.id, text, parse_mode='Markdown')
 
 @bot.message_handler(commands=['tasks'])
 def tasks_command(message):
@@ -880,26 +2899,26 @@ def ban_command(message):
     
     parts = message.text.split(maxsplit=3)
     if len(parts) < 2:
-        bot.send_message(ADMIN_ID, 
-                        "Используйте: /ban ID [время] [причина]\n"
-                        "Примеры:\n"
-                        "`/ban 123456789` - навсегда\n"
-                        "`/ban 123456789 1d` - на 1 день\n"
-                        "`/ban 123456789 1w3d5h спам`\n"
-                        "`/ban 123456789 1y1d5h10s нарушение правил`",
-                        parse_mode='Markdown')
+        outbox.send(message.chat.id, 
+                    "Используйте: /ban ID [время] [причина]\n"
+                    "Примеры:\n"
+                    "`/ban 123456789` - навсегда\n"
+                    "`/ban 123456789 1d` - на 1 день\n"
+                    "`/ban 123456789 1w3d5h спам`\n"
+                    "`/ban 123456789 1y1d5h10s нарушение правил`",
+                    parse_mode='Markdown')
         return
     
     user_id_str = parts[1]
     
     if not user_id_str.isdigit():
-        bot.send_message(ADMIN_ID, "❌ ID должен быть числом")
+        outbox.send(message.chat.id, "❌ ID должен быть числом")
         return
     
     user_id = int(user_id_str)
     
-    if user_id == ADMIN_ID:
-        bot.send_message(ADMIN_ID, "❌ Нельзя забанить себя")
+    if is_admin(user_id):
+        outbox.send(message.chat.id, "❌ Нельзя забанить администратора")
         return
     
     duration_str = ""
@@ -925,7 +2944,7 @@ def ban_command(message):
         storage.clear_violation_message(user_id)
     
     duration_text = "навсегда" if duration_seconds == 0 else format_duration(duration_seconds)
-    bot.send_message(ADMIN_ID, f"✅ Пользователь `{user_id}` забанен на {duration_text}.\nПричина: {reason}")
+    outbox.send(message.chat.id, f"✅ Пользователь `{user_id}` забанен на {duration_text}.\nПричина: {reason}")
     
     try:
         if duration_seconds == 0:
@@ -933,7 +2952,7 @@ def ban_command(message):
         else:
             ban_time = format_duration(duration_seconds)
         
-        bot.send_message(
+        outbox.send(
             user_id,
             f"🚫 Вы были заблокированы администратором.\n"
             f"Причина: {reason}\n"
@@ -941,8 +2960,6 @@ def ban_command(message):
         )
     except:
         pass
-    
-    storage.save_data()
 
 @bot.message_handler(commands=['unban'])
 def unban_command(message):
@@ -950,26 +2967,23 @@ def unban_command(message):
         return
     
     if len(message.text.split()) < 2:
-        bot.send_message(ADMIN_ID, "Используйте: /unban ID")
+        outbox.send(message.chat.id, "Используйте: /unban ID")
         return
     
     target = message.text.split(maxsplit=1)[1]
     
     if not target.isdigit():
-        bot.send_message(ADMIN_ID, "❌ ID должен быть числом")
+        outbox.send(message.chat.id, "❌ ID должен быть числом")
         return
     
     user_id = int(target)
     
     if storage.unban_user(user_id):
-        bot.send_message(ADMIN_ID, f"✅ Пользователь `{user_id}` разбанен.")
+        outbox.send(message.chat.id, f"✅ Пользователь `{user_id}` разбанен.")
         
-        try:
-            bot.send_message(user_id, "✅ Вы были разблокированы администратором.")
-        except:
-            pass
+        outbox.send(user_id, "✅ Вы были разблокированы администратором.")
     else:
-        bot.send_message(ADMIN_ID, f"❌ Пользователь `{user_id}` не найден в бан-листе.")
+        outbox.send(message.chat.id, f"❌ Пользователь `{user_id}` не найден в бан-листе.")
 
 @bot.message_handler(commands=['mute'])
 def mute_command(message):
@@ -978,26 +2992,26 @@ def mute_command(message):
     
     parts = message.text.split(maxsplit=3)
     if len(parts) < 2:
-        bot.send_message(ADMIN_ID, 
-                        "Используйте: /mute ID [время] [причина]\n"
-                        "Примеры:\n"
-                        "`/mute 123456789` - навсегда\n"
-                        "`/mute 123456789 1h` - на 1 час\n"
-                        "`/mute 123456789 2d5m флуд`\n"
-                        "`/mute 123456789 1w нарушение правил`",
-                        parse_mode='Markdown')
+        outbox.send(message.chat.id, 
+                    "Используйте: /mute ID [время] [причина]\n"
+                    "Примеры:\n"
+                    "`/mute 123456789` - навсегда\n"
+                    "`/mute 123456789 1h` - на 1 час\n"
+                    "`/mute 123456789 2d5m флуд`\n"
+                    "`/mute 123456789 1w нарушение правил`",
+                    parse_mode='Markdown')
         return
     
     user_id_str = parts[1]
     
     if not user_id_str.isdigit():
-        bot.send_message(ADMIN_ID, "❌ ID должен быть числом")
+        outbox.send(message.chat.id, "❌ ID должен быть числом")
         return
     
     user_id = int(user_id_str)
     
-    if user_id == ADMIN_ID:
-        bot.send_message(ADMIN_ID, "❌ Нельзя заглушить себя")
+    if is_admin(user_id):
+        outbox.send(message.chat.id, "❌ Нельзя заглушить администратора")
         return
     
     duration_str = ""
@@ -1017,7 +3031,7 @@ def mute_command(message):
     storage.mute_user(user_id, duration_seconds, reason)
     
     duration_text = "навсегда" if duration_seconds == 0 else format_duration(duration_seconds)
-    bot.send_message(ADMIN_ID, f"✅ Пользователь `{user_id}` заглушен на {duration_text}.\nПричина: {reason}")
+    outbox.send(message.chat.id, f"✅ Пользователь `{user_id}` заглушен на {duration_text}.\nПричина: {reason}")
     
     try:
         if duration_seconds == 0:
@@ -1025,7 +3039,7 @@ def mute_command(message):
         else:
             mute_time = format_duration(duration_seconds)
         
-        bot.send_message(
+        outbox.send(
             user_id,
             f"🔇 Вы были заглушены администратором.\n\n"
             f"⚠️ *Вам запрещено использовать прямую переписку.*\n\n"
@@ -1035,8 +3049,6 @@ def mute_command(message):
         )
     except:
         pass
-    
-    storage.save_data()
 
 @bot.message_handler(commands=['unmute'])
 def unmute_command(message):
@@ -1044,30 +3056,27 @@ def unmute_command(message):
         return
     
     if len(message.text.split()) < 2:
-        bot.send_message(ADMIN_ID, "Используйте: /unmute ID")
+        outbox.send(message.chat.id, "Используйте: /unmute ID")
         return
     
     target = message.text.split(maxsplit=1)[1]
     
     if not target.isdigit():
-        bot.send_message(ADMIN_ID, "❌ ID должен быть числом")
+        outbox.send(message.chat.id, "❌ ID должен быть числом")
         return
     
     user_id = int(target)
     
     if storage.unmute_user(user_id):
-        bot.send_message(ADMIN_ID, f"✅ Пользователь `{user_id}` разглушен.")
+        outbox.send(message.chat.id, f"✅ Пользователь `{user_id}` разглушен.")
         
-        try:
-            bot.send_message(
-                user_id,
-                "✅ Вы были разглушены администратором.\n\n"
-                "Теперь вы снова можете использовать прямую переписку."
-            )
-        except:
-            pass
+        outbox.send(
+            user_id,
+            "✅ Вы были разглушены администратором.\n\n"
+            "Теперь вы снова можете использовать прямую переписку."
+        )
     else:
-        bot.send_message(ADMIN_ID, f"❌ Пользователь `{user_id}` не найден в мут-листе.")
+        outbox.send(message.chat.id, f"❌ Пользователь `{user_id}` не найден в мут-листе.")
 
 @bot.message_handler(commands=['message'])
 def message_command(message):
@@ -1086,14 +3095,14 @@ def message_command(message):
             "`/message [123456789, Михаил] Соблюдайте правила` - без рамок\n"
             "`/message [123456789] {true} Важное объявление` - с рамками"
         )
-        bot.send_message(ADMIN_ID, help_text, parse_mode='Markdown')
+        outbox.send(message.chat.id, help_text, parse_mode='Markdown')
         return
     
     full_text = message.text[8:].strip()
     
     match = re.search(r'\[([^\]]+)\]\s*(.+)', full_text)
     if not match:
-        bot.send_message(ADMIN_ID, "❌ Неверный формат. Пример: `/message [123456789] Текст`", parse_mode='Markdown')
+        outbox.send(message.chat.id, "❌ Неверный формат. Пример: `/message [123456789] Текст`", parse_mode='Markdown')
         return
     
     params = match.group(1).strip()
@@ -1112,7 +3121,7 @@ def message_command(message):
                 frames_option = True
     
     if not message_text:
-        bot.send_message(ADMIN_ID, "❌ Введите текст сообщения.")
+        outbox.send(message.chat.id, "❌ Введите текст сообщения.")
         return
     
     if ',' in params:
@@ -1124,17 +3133,17 @@ def message_command(message):
         admin_name = "Модератор"
     
     if not user_id_str.isdigit():
-        bot.send_message(ADMIN_ID, "❌ ID должен быть числом")
+        outbox.send(message.chat.id, "❌ ID должен быть числом")
         return
     
     user_id = int(user_id_str)
     
     if user_id not in storage.user_profiles:
-        bot.send_message(ADMIN_ID, f"❌ Пользователь с ID `{user_id}` не найден")
+        outbox.send(message.chat.id, f"❌ Пользователь с ID `{user_id}` не найден")
         return
     
     if storage.is_banned(user_id) is True:
-        bot.send_message(ADMIN_ID, f"⚠️ Пользователь `{user_id}` забанен")
+        outbox.send(message.chat.id, f"⚠️ Пользователь `{user_id}` забанен")
         return
     
     if frames_option:
@@ -1152,11 +3161,13 @@ def message_command(message):
             f"_Это автоматическое уведомление_"
         )
     
-    try:
-        bot.send_message(user_id, formatted_message, parse_mode='Markdown')
-        bot.send_message(ADMIN_ID, f"✅ Сообщение отправлено пользователю `{user_id}`")
-    except Exception as e:
-        bot.send_message(ADMIN_ID, f"❌ Ошибка: {str(e)}")
+    outbox.send(
+        user_id,
+        formatted_message,
+        parse_mode='Markdown',
+        on_sent=lambda sent: outbox.send(message.chat.id, f"✅ Сообщение отправлено пользователю `{user_id}`"),
+        on_error=lambda e: outbox.send(message.chat.id, f"❌ Ошибка: {str(e)}")
+    )
 
 @bot.message_handler(func=lambda m: m.text and m.text.startswith(('/full', '/Full')))
 def full_command(message):
@@ -1182,12 +3193,12 @@ def full_command(message):
             question_id = int(parts[1])
     
     if question_id:
-        show_full_question_text(ADMIN_ID, question_id)
+        show_full_question_text(message.chat.id, question_id)
         return
     
-    if ADMIN_ID in storage.admin_pending_answers:
-        question_id = storage.admin_pending_answers[ADMIN_ID]
-        show_full_question_text(ADMIN_ID, question_id)
+    if message.from_user.id in storage.admin_pending_answers:
+        question_id = storage.admin_pending_answers[message.from_user.id]
+        show_full_question_text(message.chat.id, question_id)
         return
     
     if message.reply_to_message:
@@ -1205,11 +3216,11 @@ def full_command(message):
                         break
         
         if question_id:
-            show_full_question_text(ADMIN_ID, question_id)
+            show_full_question_text(message.chat.id, question_id)
             return
     
-    bot.send_message(
-        ADMIN_ID,
+    outbox.send(
+        message.chat.id,
         "❌ Используйте команду:\n"
         "• `/full#1` (без пробела)\n"
         "• `/full #1` (с пробелом)\n"
@@ -1220,12 +3231,11 @@ def full_command(message):
     )
 
 def show_full_question_text(admin_id, question_id):
-    if question_id not in storage.questions:
-        bot.send_message(admin_id, "❌ Вопрос не найден.")
+    question = storage.get_question(question_id)
+    if question is None:
+        outbox.send(admin_id, "❌ Вопрос не найден.")
         return
     
-    question = storage.questions[question_id]
-    
     full_text = f"📨 *Полный текст вопроса #{question_id}*\n\n"
     
     user_id_display = f"`{question['user_id']}`"
@@ -1237,28 +3247,29 @@ def show_full_question_text(admin_id, question_id):
     full_text += f"⏰ {question['time']} | {question['date']}\n\n"
     full_text += f"💬 {question['text']}"
     
-    urls = re.findall(r'(?i)https?://[^\s<>"]+|www\.[^\s<>"]+\.[^\s<>"]+', question['text'])
-    if urls:
-        full_text += f"\n\n🔗 *Ссылки ({len(urls)}):*\n"
-        for i, url in enumerate(urls, 1):
+    spans, _, _ = scan_urls(question['text'])
+    if spans:
+        full_text += f"\n\n🔗 *Ссылки ({len(spans)}):*\n"
+        for i, (start, end) in enumerate(spans, 1):
+            url = question['text'][start:end]
             full_text += f"{i}. {url}\n"
     
-    bot.send_message(admin_id, full_text, parse_mode='Markdown', disable_web_page_preview=True)
+    outbox.send(admin_id, full_text, parse_mode='Markdown', disable_web_page_preview=True)
     
     if admin_id in storage.admin_pending_answers:
-        msg = bot.send_message(
+        outbox.send(
             admin_id,
             f"Теперь введите ответ на вопрос #{question_id}:\n"
             f"Используйте [Имя Фамилия] в начале для подписи",
             parse_mode='Markdown'
         )
-        bot.register_next_step_handler(msg, process_admin_answer, question_id)
+        bot.register_next_step_handler_by_chat_id(admin_id, process_admin_answer, question_id)
 
 def show_full_violation_message(admin_id, user_id):
     """Показывает полное сообщение с ссылками при нарушении правил чата"""
     violation = storage.get_violation_message(user_id)
     if not violation:
-        bot.send_message(admin_id, "❌ Данные о нарушении не найдены.")
+        outbox.send(admin_id, "❌ Данные о нарушении не найдены.")
         return
     
     user_profile = storage.user_profiles.get(user_id, {})
@@ -1274,7 +3285,7 @@ def show_full_violation_message(admin_id, user_id):
     for i, url in enumerate(violation['urls'], 1):
         message_text += f"{i}. {url}\n"
     
-    bot.send_message(admin_id, message_text, parse_mode='Markdown', disable_web_page_preview=True)
+    outbox.send(admin_id, message_text, parse_mode='Markdown', disable_web_page_preview=True)
 
 # ===== ОБРАБОТКА СООБЩЕНИЙ =====
 @bot.message_handler(func=lambda m: True)
@@ -1286,15 +3297,15 @@ def handle_all_messages(message):
         return
     
     # Проверка на спам
-    if storage.check_spam(user_id):
+    if not rate_limiter.allow(user_id, 'message'):
         storage.ban_user(user_id, 3600, "Спам (более 10 сообщений за 10 секунд)")
-        bot.send_message(
+        outbox.send(
             user_id,
             "🚫 Вы были заблокированы за спам на 1 час."
         )
         return
     
-    if is_admin(user_id) and message.chat.id == ADMIN_ID:
+    if is_admin(user_id) and message.chat.id == user_id:
         handle_admin_actions(message)
         return
     
@@ -1306,11 +3317,13 @@ def handle_all_messages(message):
         handle_user_menu_buttons(message)
 
 def handle_admin_actions(message):
+    admin_id = message.from_user.id
+    
     # Проверяем, есть ли ожидающий ответ с кнопки "Ответить"
-    pending_reply = storage.get_pending_reply(ADMIN_ID)
-    if pending_reply and message.content_type == 'text' and not message.text.startswith('/'):
+    is_plain_text = message.content_type == 'text' and not message.text.startswith('/')
+    pending_reply = storage.take_pending_reply(admin_id) if is_plain_text else None
+    if pending_reply:
         reply_to_text = pending_reply['reply_to_text']
-        storage.clear_pending_reply(ADMIN_ID)
         
         # Экранируем текст для Markdown
         escaped_reply_text = escape_markdown(message.text)
@@ -1319,66 +3332,55 @@ def handle_admin_actions(message):
         # Формируем сообщение с ответом
         reply_text = f"↪️ *Ответ на:* {escaped_original_text}\n_________________\n{escaped_reply_text}"
         
-        # Находим активный чат
-        active_user_id = None
-        for uid, chat_data in storage.active_chats.items():
-            if chat_data['admin_id'] == ADMIN_ID:
-                active_user_id = uid
-                break
+        # Чат берём из кнопки, иначе - по reply или единственному чату
+        active_user_id = pending_reply.get('user_id') or resolve_admin_chat(message)
+        chat_data = storage.active_chats.get(active_user_id)
         
-        if active_user_id:
-            chat_data = storage.active_chats[active_user_id]
+        if chat_data and chat_data.get('admin_id') == admin_id:
             
-            try:
-                sent_msg = bot.send_message(
-                    active_user_id,
-                    f"👨‍💼 *{chat_data['admin_name']} (Администратор):*\n{reply_text}",
-                    parse_mode='Markdown'
-                )
-                
-                storage.add_to_message_history(active_user_id, sent_msg.message_id, message.text, is_admin=True)
-            except Exception as e:
-                bot.send_message(ADMIN_ID, f"❌ Не удалось отправить: {str(e)}")
+            outbox.send(
+                active_user_id,
+                f"👨‍💼 *{chat_data['admin_name']} (Администратор):*\n{reply_text}",
+                parse_mode='Markdown',
+                on_sent=lambda sent: storage.add_to_message_history(active_user_id, sent.message_id, message.text, is_admin=True),
+                on_error=lambda e: outbox.send(admin_id, f"❌ Не удалось отправить: {str(e)}")
+            )
         
         return
     
-    if ADMIN_ID in storage.admin_pending_answers:
+    if admin_id in storage.admin_pending_answers:
         if message.content_type == 'text' and message.text.strip().lower().startswith('/full'):
-            question_id = storage.admin_pending_answers[ADMIN_ID]
-            show_full_question_text(ADMIN_ID, question_id)
+            question_id = storage.admin_pending_answers[admin_id]
+            show_full_question_text(admin_id, question_id)
             return
         
-        question_id = storage.admin_pending_answers[ADMIN_ID]
-        del storage.admin_pending_answers[ADMIN_ID]
+        question_id = storage.admin_pending_answers[admin_id]
+        storage.remove_item('admin_pending_answers', admin_id)
         process_admin_answer(message, question_id)
         return
     
-    if message.text in ['📋 Задачи (/tasks)', '💬 Активные чаты', '🚫 Бан-лист', '🔇 Мут-лист', '🔄 Обновить']:
-        if message.text == '📋 Задачи (/tasks)':
-            show_tasks(message)
-        elif message.text == '💬 Активные чаты':
-            show_active_chats(message)
-        elif message.text == '🚫 Бан-лист':
-            show_bans(message)
-        elif message.text == '🔇 Мут-лист':
-            show_mutes(message)
-        elif message.text == '🔄 Обновить':
-            admin_panel(message)
-    else:
+    if message.content_type != 'text' or not admin_buttons.dispatch(message.text, message):
         handle_admin_to_user(message)
 
 def handle_user_menu_buttons(message):
     user_id = message.from_user.id
     
     if message.text == '📨 Задать вопрос':
+        # Частые нажатия молча игнорируем, чтобы не отвечать на каждое
+        if not rate_limiter.allow(user_id, 'question'):
+            return
+        
         cooldown_check, remaining = check_cooldown(user_id, 'question')
         if not cooldown_check:
-            bot.send_message(user_id, f"⏳ Следующий вопрос можно задать через {remaining} секунд.")
+            outbox.send(user_id, f"⏳ Следующий вопрос можно задать через {remaining} секунд.")
             return
         
         ask_question_start(user_id)
         
     elif message.text == '💬 Прямая переписка':
+        if not rate_limiter.allow(user_id, 'chat_request'):
+            return
+        
         # Проверяем, не заглушен ли пользователь
         if storage.is_muted(user_id) is True:
             mute_data = storage.muted_users[user_id]
@@ -1391,7 +3393,7 @@ def handle_user_menu_buttons(message):
                 else:
                     mute_time = "истёк"
             
-            bot.send_message(
+            outbox.send(
                 user_id,
                 f"🔇 *Вам запрещено использовать прямую переписку!*\n\n"
                 f"Причина: {mute_data['reason']}\n"
@@ -1402,7 +3404,7 @@ def handle_user_menu_buttons(message):
         
         cooldown_check, remaining = check_cooldown(user_id, 'chat_request')
         if not cooldown_check:
-            bot.send_message(user_id, f"⏳ Следующий запрос переписки можно отправить через {remaining} секунд.")
+            outbox.send(user_id, f"⏳ Следующий запрос переписки можно отправить через {remaining} секунд.")
             return
         
         request_chat_flow(user_id)
@@ -1418,11 +3420,17 @@ def handle_user_in_chat(message):
     if not chat_data:
         return
     
+    admin_id = chat_data.get('admin_id')
+    if admin_id is None:
+        # Админ ещё настраивает чат: пересылать пока некому
+        outbox.send(user_id, "⏳ Администратор настраивает переписку, подождите.")
+        return
+    
     # Проверяем, есть ли ожидающий ответ с кнопки "Ответить"
-    pending_reply = storage.get_pending_reply(user_id)
-    if pending_reply and message.content_type == 'text' and not message.text.startswith('/'):
+    is_plain_text = message.content_type == 'text' and not message.text.startswith('/')
+    pending_reply = storage.take_pending_reply(user_id) if is_plain_text else None
+    if pending_reply:
         reply_to_text = pending_reply['reply_to_text']
-        storage.clear_pending_reply(user_id)
         
         # Экранируем текст для Markdown
         escaped_reply_text = escape_markdown(message.text)
@@ -1434,29 +3442,26 @@ def handle_user_in_chat(message):
         # Отправляем админу
         sender = chat_data['user_name']
         
-        try:
-            sent_msg = bot.send_message(
-                ADMIN_ID,
-                f"👤 *{sender}:*\n{reply_text}",
-                parse_mode='Markdown',
-                disable_web_page_preview=True
-            )
-            
-            storage.add_to_message_history(ADMIN_ID, sent_msg.message_id, message.text, is_admin=False)
-        except Exception as e:
-            bot.send_message(user_id, f"❌ Ошибка отправки: {str(e)}")
+        outbox.send(
+            admin_id,
+            f"👤 *{sender}:*\n{reply_text}",
+            parse_mode='Markdown',
+            disable_web_page_preview=True,
+            on_sent=forwarded_to_admin(admin_id, user_id, message.text),
+            on_error=lambda e: outbox.send(user_id, f"❌ Ошибка отправки: {str(e)}")
+        )
         
         return
     
     # Разрешаем ТОЛЬКО текстовые сообщения в чате
     if message.content_type != 'text':
-        bot.send_message(user_id, "❌ В чате разрешены только текстовые сообщения.")
+        outbox.send(user_id, "❌ В чате разрешены только текстовые сообщения.")
         return
     
     # Проверяем лимит символов для чата
     chat_limit = storage.chat_limits.get(user_id, 350)
     if len(message.text) > chat_limit:
-        bot.send_message(user_id, f"⚠️ Сообщение слишком длинное ({len(message.text)}/{chat_limit} символов)")
+        outbox.send(user_id, f"⚠️ Сообщение слишком длинное ({len(message.text)}/{chat_limit} символов)")
         return
     
     # Проверяем настройки чата
@@ -1467,11 +3472,10 @@ def handle_user_in_chat(message):
         text = message.text.strip()
         
         # Проверяем есть ли ссылки
-        urls = find_all_urls(text)
+        _, urls, masked_text = scan_urls(text)
         
         if urls and not allow_links:
-            # Ссылки запрещены - маскируем и завершаем чат
-            masked_text, url_count = find_and_mask_urls(text)
+            # Ссылки запрещены - завершаем чат
             
             # Сохраняем полный текст и ссылки для просмотра
             current_time = datetime.now().strftime("%H:%M")
@@ -1490,87 +3494,76 @@ def handle_user_in_chat(message):
                 types.InlineKeyboardButton('🚫 Забанить', callback_data=f'ban_user_{user_id}'),
                 types.InlineKeyboardButton('🔇 Заглушить', callback_data=f'mute_user_{user_id}'),
                 types.InlineKeyboardButton('*Полностью*', callback_data=f'view_violation_{user_id}'),
-                types.InlineKeyboardButton('💬 Ответить', callback_data=f'reply_to_msg_{user_id}_{text[:50].replace("_", " ")}')
+                types.InlineKeyboardButton('💬 Ответить', callback_data=callback_registry.issue('reply_to_user', user_id=user_id, text=masked_text[:100]))
             )
             
-            sent_msg = bot.send_message(
-                ADMIN_ID,
+            outbox.send(
+                admin_id,
                 admin_message,
                 parse_mode='Markdown',
                 reply_markup=markup,
-                disable_web_page_preview=True
+                disable_web_page_preview=True,
+                on_sent=lambda sent: storage.add_to_message_history(admin_id, sent.message_id, masked_text, is_admin=False)
             )
             
-            storage.add_to_message_history(ADMIN_ID, sent_msg.message_id, masked_text, is_admin=False)
-            
             # Завершаем чат
             end_chat(user_id, "link_sent")
-            bot.send_message(user_id, "⏹ Переписка завершена. Отправка ссылок запрещена.")
+            outbox.send(user_id, "⏹ Переписка завершена. Отправка ссылок запрещена.")
             
             return
         
         # Если ссылки разрешены или их нет
-        # Экранируем текст для безопасного использования в callback_data
-        safe_text = text[:50].replace('_', ' ').replace('*', '').replace('`', '').replace('[', '').replace(']', '')
-        
         # Создаем сообщение с кнопкой "Ответить"
         markup = types.InlineKeyboardMarkup()
         markup.add(
-            types.InlineKeyboardButton('💬 Ответить', callback_data=f'reply_to_msg_{user_id}_{safe_text}')
+            types.InlineKeyboardButton('💬 Ответить', callback_data=callback_registry.issue('reply_to_user', user_id=user_id, text=text[:100]))
         )
         
-        sent_msg = bot.send_message(
-            ADMIN_ID,
+        outbox.send(
+            admin_id,
             f"👤 *{sender}:*\n{escape_markdown(text[:500])}",
             parse_mode='Markdown',
             reply_markup=markup,
-            disable_web_page_preview=True
+            disable_web_page_preview=True,
+            on_sent=forwarded_to_admin(admin_id, user_id, text),
+            on_error=lambda e: outbox.send(user_id, f"❌ Ошибка отправки: {str(e)}")
         )
-        
-        storage.add_to_message_history(ADMIN_ID, sent_msg.message_id, text, is_admin=False)
             
     except Exception as e:
-        bot.send_message(user_id, f"❌ Ошибка отправки: {str(e)}")
+        outbox.send(user_id, f"❌ Ошибка отправки: {str(e)}")
 
 def handle_admin_to_user(message):
-    active_user_id = None
-    for user_id, chat_data in storage.active_chats.items():
-        if chat_data['admin_id'] == ADMIN_ID:
-            active_user_id = user_id
-            break
+    admin_id = message.from_user.id
+    active_user_id = resolve_admin_chat(message)
+    chat_data = storage.active_chats.get(active_user_id)
     
-    if not active_user_id:
+    if not chat_data:
         return
     
-    chat_data = storage.active_chats[active_user_id]
-    
     try:
         if message.content_type == 'text':
-            # Экранируем текст для безопасного использования в callback_data
-            safe_text = message.text[:50].replace('_', ' ').replace('*', '').replace('`', '').replace('[', '').replace(']', '')
-            
             # Создаем сообщение с кнопкой "Ответить"
             markup = types.InlineKeyboardMarkup()
             markup.add(
-                types.InlineKeyboardButton('💬 Ответить', callback_data=f'reply_to_msg_admin_{safe_text}')
+                types.InlineKeyboardButton('💬 Ответить', callback_data=callback_registry.issue('reply_to_admin', text=message.text[:100]))
             )
             
-            sent_msg = bot.send_message(
+            outbox.send(
                 active_user_id,
                 f"👨‍💼 *{chat_data['admin_name']} (Администратор):*\n{escape_markdown(message.text)}",
                 parse_mode='Markdown',
-                reply_markup=markup
+                reply_markup=markup,
+                on_sent=lambda sent: storage.add_to_message_history(active_user_id, sent.message_id, message.text, is_admin=True),
+                on_error=lambda e: outbox.send(admin_id, f"❌ Не удалось отправить: {str(e)}")
             )
-            
-            storage.add_to_message_history(active_user_id, sent_msg.message_id, message.text, is_admin=True)
     except Exception as e:
-        bot.send_message(ADMIN_ID, f"❌ Не удалось отправить: {str(e)}")
+        outbox.send(admin_id, f"❌ Не удалось отправить: {str(e)}")
 
 # ===== ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ =====
 def ask_question_start(user_id):
     can_ask, active_count = storage.can_ask_question(user_id)
     if not can_ask:
-        bot.send_message(
+        outbox.send(
             user_id, 
             f"❌ *Превышен лимит активных вопросов!*\n\n"
             f"У вас уже {active_count}/{storage.max_active_questions} активных вопросов.\n"
@@ -1579,7 +3572,7 @@ def ask_question_start(user_id):
         )
         return
     
-    msg = bot.send_message(
+    outbox.send(
         user_id,
         "📝 *Напишите ваш вопрос:*\n\n"
         f"Максимум {QUESTION_LIMIT} символов.\n"
@@ -1588,18 +3581,18 @@ def ask_question_start(user_id):
         parse_mode='Markdown',
         reply_markup=types.ReplyKeyboardRemove()
     )
-    bot.register_next_step_handler(msg, process_question)
+    bot.register_next_step_handler_by_chat_id(user_id, process_question)
 
 def process_question(message):
     user_id = message.from_user.id
     
     if message.text and message.text.strip() == '/cancel':
-        bot.send_message(user_id, "❌ Отправка вопроса отменена.")
+        outbox.send(user_id, "❌ Отправка вопроса отменена.")
         start_command(message)
         return
     
     if message.content_type != 'text':
-        bot.send_message(
+        outbox.send(
             user_id, 
             "❌ *Поддерживаются только текстовые вопросы!*\n\n"
             "Фото, голосовые и другие медиафайлы не принимаются.\n"
@@ -1614,19 +3607,20 @@ def process_question(message):
     question_text = message.text.strip()
     
     if len(question_text) > QUESTION_LIMIT:
-        bot.send_message(user_id, f"❌ Вопрос слишком длинный (макс. {QUESTION_LIMIT} символов).")
+        outbox.send(user_id, f"❌ Вопрос слишком длинный (макс. {QUESTION_LIMIT} символов).")
         start_command(message)
         return
     
     if len(question_text) < 10:
-        bot.send_message(user_id, "❌ Вопрос слишком короткий (минимум 10 символов).")
+        outbox.send(user_id, "❌ Вопрос слишком короткий (минимум 10 символов).")
         start_command(message)
         return
     
-    question_id = storage.question_counter
+    question_id = storage.next_question_id()
     username = storage.user_profiles[user_id]['username']
     
-    masked_text, url_count = find_and_mask_urls(question_text)
+    spans, _, masked_text = scan_urls(question_text)
+    url_count = len(spans)
     
     question_data = {
         'id': question_id,
@@ -1639,18 +3633,19 @@ def process_question(message):
         'date': datetime.now().strftime("%d.%m.%Y"),
         'status': 'pending',
         'admin_response': None,
+        'admin_id': storage.pick_admin(ADMIN_IDS),
         'created_at': datetime.now().isoformat()
     }
     
-    storage.questions[question_id] = question_data
+    storage.add_question(question_data)
     storage.user_profiles[user_id]['questions_sent'] += 1
-    storage.question_counter += 1
+    storage.save_item('user_profiles', user_id)
     
     notify_admin_about_question(question_id, question_data)
     
     confirm_text = f"✅ *Вопрос #{question_id} отправлен!*\n\nАдминистратор ответит в ближайшее время."
     
-    bot.send_message(user_id, confirm_text, parse_mode='Markdown')
+    outbox.send(user_id, confirm_text, parse_mode='Markdown')
     
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     markup.add(
@@ -1658,18 +3653,17 @@ def process_question(message):
         types.KeyboardButton('💬 Прямая переписка'),
         types.KeyboardButton('ℹ️ Помощь')
     )
-    bot.send_message(user_id, "Главное меню:", reply_markup=markup)
-    
-    storage.save_data()
+    outbox.send(user_id, "Главное меню:", reply_markup=markup)
 
 def request_chat_flow(user_id):
     username = storage.user_profiles[user_id]['username']
     
     set_cooldown(user_id, 'chat_request')
     
-    chat_request_id = storage.question_counter
+    chat_request_id = storage.next_question_id()
+    admin_id = storage.pick_admin(ADMIN_IDS)
     
-    storage.questions[chat_request_id] = {
+    storage.add_question({
         'id': chat_request_id,
         'user_id': user_id,
         'username': username,
@@ -1678,10 +3672,9 @@ def request_chat_flow(user_id):
         'date': datetime.now().strftime("%d.%m.%Y"),
         'type': 'chat_request',
         'status': 'pending',
+        'admin_id': admin_id,
         'created_at': datetime.now().isoformat()
-    }
-    
-    storage.question_counter += 1
+    })
     
     markup = types.InlineKeyboardMarkup()
     markup.add(
@@ -1689,8 +3682,8 @@ def request_chat_flow(user_id):
         types.InlineKeyboardButton('❌ Отклонить', callback_data=f'reject_chat_{chat_request_id}')
     )
     
-    bot.send_message(
-        ADMIN_ID,
+    outbox.send(
+        admin_id,
         f"💬 *Запрос на переписку #{chat_request_id}*\n"
         f"От: {username}\n"
         f"ID: `{user_id}`\n"
@@ -1700,134 +3693,200 @@ def request_chat_flow(user_id):
         disable_web_page_preview=True
     )
     
-    bot.send_message(user_id, "✅ Запрос на переписку отправлен администратору!")
+    outbox.send(user_id, "✅ Запрос на переписку отправлен администратору!")
+    
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(
+        types.KeyboardButton('📨 Задать вопрос'),
+        types.KeyboardButton('💬 Прямая переписка'),
+        types.KeyboardButton('ℹ️ Помощь')
+    )
+    outbox.send(user_id, "Главное меню:", reply_markup=markup)
+
+# ===== ФУНКЦИИ ДЛЯ АДМИНА =====
+# Фильтры списка задач: {ключ: (подпись кнопки, тип записи или None - все)}
+TASK_FILTERS = {
+    'all': ('Все', None),
+    'q': ('Вопросы', 'question'),
+    'chat': ('Переписки', 'chat_request')
+}
+
+def render_task_entries(task_filter):
+    """Компактные строки списка задач: (id вопроса, строка)"""
+    wanted_type = TASK_FILTERS[task_filter][1]
+    entries = []
+    for question in storage.get_pending_questions():
+        if wanted_type and (question.get('type') or 'question') != wanted_type:
+            continue
+        
+        display_text = question.get('masked_text', question['text'])
+        text_preview = display_text[:40] + "..." if len(display_text) > 40 else display_text
+        icon = '💬' if question.get('type') == 'chat_request' else '🔔'
+        if question.get('claimed_by') is not None:
+            icon += '🔒'  # Уже взят одним из админов
+        
+        entries.append((
+            question['id'],
+            f"{icon} #{question['id']} | {question['username']} | {question['time']} {question['date']}\n"
+            f"      {text_preview}\n"
+        ))
+    return entries
+
+def render_tasks_page(page, task_filter):
+    """Текст и клавиатура одной страницы /tasks"""
+    entries = view_cache.get(f'tasks_{task_filter}', ('questions',),
+                             lambda: render_task_entries(task_filter))
+    
+    pages = max(1, (len(entries) + TASKS_PAGE_SIZE - 1) // TASKS_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    page_entries = entries[page * TASKS_PAGE_SIZE:(page + 1) * TASKS_PAGE_SIZE]
+    
+    markup = types.InlineKeyboardMarkup(row_width=5)
+    
+    if not entries:
+        text = "✅ *Все вопросы обработаны!*"
+    else:
+        text = f"📋 *Задачи: {len(entries)}* | {TASK_FILTERS[task_filter][0]} | стр. {page + 1}/{pages}\n\n"
+        for question_id, line in page_entries:
+            # Срок ответа зависит от времени, поэтому проверяется при каждом показе
+            can_answer, _ = can_answer_question(question_id)
+            text += line if can_answer else line.replace(f"#{question_id}", f"#{question_id} ⏰", 1)
+        
+        markup.add(*[
+            types.InlineKeyboardButton(f'#{question_id}', callback_data=f'task_open_{question_id}')
+            for question_id, _ in page_entries
+        ])
+    
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton('◀️', callback_data=f'tasks_page_{page - 1}_{task_filter}'))
+    navigation.append(types.InlineKeyboardButton('🔄', callback_data=f'tasks_page_{page}_{task_filter}'))
+    if page < pages - 1:
+        navigation.append(types.InlineKeyboardButton('▶️', callback_data=f'tasks_page_{page + 1}_{task_filter}'))
+    markup.row(*navigation)
+    
+    markup.row(*[
+        types.InlineKeyboardButton(('• ' if key == task_filter else '') + label,
+                                   callback_data=f'tasks_page_0_{key}')
+        for key, (label, _) in TASK_FILTERS.items()
+    ])
+    
+    return text, markup
+
+@admin_buttons.route('📋 Задачи (/tasks)')
+def show_tasks(message):
+    text, markup = render_tasks_page(0, 'all')
+    outbox.send(message.chat.id, text, parse_mode='Markdown', reply_markup=markup, disable_web_page_preview=True)
+
+def show_task_card(admin_id, question_id):
+    """Отправляет карточку задачи с кнопками ответа, бана и мута"""
+    question = storage.questions[question_id]
+    
+    can_answer, reason = can_answer_question(question_id)
+    answer_button_text = f'Ответить #{question_id}'
+    if not can_answer:
+        answer_button_text += ' ⏰'
+    
+    display_text = question.get('masked_text', question['text'])
+    text_preview = display_text[:80] + "..." if len(display_text) > 80 else display_text
     
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
-        types.KeyboardButton('📨 Задать вопрос'),
-        types.KeyboardButton('💬 Прямая переписка'),
-        types.KeyboardButton('ℹ️ Помощь')
+        types.InlineKeyboardButton(answer_button_text, callback_data=f'answer_{question_id}'),
+        types.InlineKeyboardButton('🚫 Забанить', callback_data=f'ban_{question_id}'),
+        types.InlineKeyboardButton('🔇 Заглушить', callback_data=f'mute_{question_id}')
     )
-    bot.send_message(user_id, "Главное меню:", reply_markup=markup)
     
-    storage.save_data()
-
-# ===== ФУНКЦИИ ДЛЯ АДМИНА =====
-def show_tasks(message):
-    pending_questions = [q for q in storage.questions.values() if q.get('status') == 'pending']
+    user_id_display = f"`{question['user_id']}`"
     
-    if not pending_questions:
-        bot.send_message(ADMIN_ID, "✅ *Все вопросы обработаны!*", parse_mode='Markdown')
-        return
+    question_text = (
+        f"🔔 #{question['id']}\n"
+        f"👤 {question['username']} ({user_id_display})\n"
+        f"⏰ {question['time']} | {question['date']}\n"
+    )
     
-    bot.send_message(ADMIN_ID, f"📋 *Задачи: {len(pending_questions)}*", parse_mode='Markdown')
+    if not can_answer:
+        question_text += f"\n⚠️ {reason}\n"
     
-    for question in pending_questions:
-        can_answer, reason = can_answer_question(question['id'])
-        answer_button_text = f'Ответить #{question["id"]}'
-        if not can_answer:
-            answer_button_text += ' ⏰'
-        
-        display_text = question.get('masked_text', question['text'])
-        text_preview = display_text[:80] + "..." if len(display_text) > 80 else display_text
-        
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton(answer_button_text, callback_data=f'answer_{question["id"]}'),
-            types.InlineKeyboardButton('🚫 Забанить', callback_data=f'ban_{question["id"]}'),
-            types.InlineKeyboardButton('🔇 Заглушить', callback_data=f'mute_{question["id"]}')
-        )
-        
-        user_id_display = f"`{question['user_id']}`"
-        
-        question_text = (
-            f"🔔 #{question['id']}\n"
-            f"👤 {question['username']} ({user_id_display})\n"
-            f"⏰ {question['time']} | {question['date']}\n"
-        )
-        
-        if not can_answer:
-            question_text += f"\n⚠️ {reason}\n"
-        
-        question_text += f"\n{text_preview}"
-        
-        bot.send_message(ADMIN_ID, question_text, parse_mode='Markdown', 
-                        reply_markup=markup, disable_web_page_preview=True)
-
-def show_active_chats(message):
-    if not storage.active_chats:
-        bot.send_message(ADMIN_ID, "💭 Нет активных чатов")
-        return
+    question_text += f"\n{text_preview}"
     
-    text = "💬 *Активные чаты:*\n\n"
-    for user_id, chat_data in storage.active_chats.items():
-        if chat_data['admin_id'] == ADMIN_ID:
+    outbox.send(admin_id, question_text, parse_mode='Markdown', 
+                reply_markup=markup, disable_web_page_preview=True)
+
+def render_active_chats(admin_id):
+    text = ""
+    for user_id in storage.get_admin_chats(admin_id):
+        chat_data = storage.active_chats.get(user_id)
+        if chat_data:
             chat_limit = storage.chat_limits.get(user_id, 350)
             text += f"👤 {chat_data['user_name']}\n"
             text += f"ID: `{user_id}`\n"
             text += f"Имя админа: {chat_data['admin_name']}\n"
             text += f"Лимит: {chat_limit} символов\n"
             text += f"Ссылки: {'✅ Разрешены' if storage.chat_settings.get(user_id, {}).get('allow_links', True) else '❌ Запрещены'}\n\n"
-    
-    bot.send_message(ADMIN_ID, text, parse_mode='Markdown')
+    return "💬 *Активные чаты:*\n\n" + text
 
-def show_bans(message):
-    active_bans = []
-    for user_id, ban_data in storage.banned_users.items():
-        if ban_data['until'] == 0 or time.time() < ban_data['until']:
-            active_bans.append((user_id, ban_data))
-    
-    if not active_bans:
-        bot.send_message(ADMIN_ID, "✅ Нет активных банов")
+@admin_buttons.route('💬 Активные чаты')
+def show_active_chats(message):
+    if not storage.active_chats:
+        outbox.send(message.chat.id, "💭 Нет активных чатов")
         return
     
-    text = "🚫 *Бан-лист:*\n\n"
-    for user_id, ban_data in active_bans:
+    text = view_cache.get(f'active_chats_{message.chat.id}', ('active_chats', 'chat_limits', 'chat_settings'),
+                          lambda: render_active_chats(message.chat.id))
+    outbox.send(message.chat.id, text, parse_mode='Markdown')
+
+def render_restrictions(collection, label):
+    """Строки бан- или мут-листа: (срок, текст до срока, текст после срока)"""
+    entries = []
+    for user_id, data in list(getattr(storage, collection).items()):
         username = storage.user_profiles.get(user_id, {}).get('username', f'ID: {user_id}')
-        
-        if ban_data['until'] == 0:
+        entries.append((
+            data['until'],
+            f"• {username} (`{user_id}`)\n"
+            f"  Причина: {data['reason']}\n"
+            f"  {label}: ",
+            "\n\n"
+        ))
+    return entries
+
+def format_restrictions(title, entries):
+    """Собирает список из закэшированных строк, пересчитывая только оставшееся время"""
+    now = time.time()
+    parts = [title]
+    for until, head, tail in entries:
+        if until == 0:
             duration = "навсегда"
+        elif until > now:
+            duration = f"ещё {format_duration(int(until - now))}"
         else:
-            remaining = ban_data['until'] - time.time()
-            if remaining > 0:
-                duration = f"ещё {format_duration(int(remaining))}"
-            else:
-                duration = "истёк"
-        
-        text += f"• {username} (`{user_id}`)\n"
-        text += f"  Причина: {ban_data['reason']}\n"
-        text += f"  Бан: {duration}\n\n"
+            continue  # Истёк, но ещё не снят планировщиком
+        parts.append(head + duration + tail)
+    return ''.join(parts) if len(parts) > 1 else None
+
+@admin_buttons.route('🚫 Бан-лист')
+def show_bans(message):
+    entries = view_cache.get('bans', ('banned_users', 'user_profiles'),
+                             lambda: render_restrictions('banned_users', 'Бан'))
+    text = format_restrictions("🚫 *Бан-лист:*\n\n", entries)
     
-    bot.send_message(ADMIN_ID, text, parse_mode='Markdown')
+    if not text:
+        outbox.send(message.chat.id, "✅ Нет активных банов")
+        return
+    
+    outbox.send(message.chat.id, text, parse_mode='Markdown')
 
+@admin_buttons.route('🔇 Мут-лист')
 def show_mutes(message):
-    active_mutes = []
-    for user_id, mute_data in storage.muted_users.items():
-        if mute_data['until'] == 0 or time.time() < mute_data['until']:
-            active_mutes.append((user_id, mute_data))
+    entries = view_cache.get('mutes', ('muted_users', 'user_profiles'),
+                             lambda: render_restrictions('muted_users', 'Мут'))
+    text = format_restrictions("🔇 *Мут-лист:*\n\n", entries)
     
-    if not active_mutes:
-        bot.send_message(ADMIN_ID, "✅ Нет активных мутов")
+    if not text:
+        outbox.send(message.chat.id, "✅ Нет активных мутов")
         return
     
-    text = "🔇 *Мут-лист:*\n\n"
-    for user_id, mute_data in active_mutes:
-        username = storage.user_profiles.get(user_id, {}).get('username', f'ID: {user_id}')
-        
-        if mute_data['until'] == 0:
-            duration = "навсегда"
-        else:
-            remaining = mute_data['until'] - time.time()
-            if remaining > 0:
-                duration = f"ещё {format_duration(int(remaining))}"
-            else:
-                duration = "истёк"
-        
-        text += f"• {username} (`{user_id}`)\n"
-        text += f"  Причина: {mute_data['reason']}\n"
-        text += f"  Мут: {duration}\n\n"
-    
-    bot.send_message(ADMIN_ID, text, parse_mode='Markdown')
+    outbox.send(message.chat.id, text, parse_mode='Markdown')
 
 def notify_admin_about_question(question_id, question_data):
     display_text = question_data.get('masked_text', question_data['text'])
@@ -1867,17 +3926,18 @@ def notify_admin_about_question(question_id, question_data):
     if question_data.get('url_count', 0) > 0:
         notification += f"\n\n🔗 *Важно:* для просмотра полного текста со ссылками используйте [/full#{question_id}](#full_{question_id})"
     
-    bot.send_message(ADMIN_ID, notification, parse_mode='Markdown', 
-                     reply_markup=markup, disable_web_page_preview=True)
+    outbox.send(question_data['admin_id'], notification, parse_mode='Markdown', 
+                reply_markup=markup, disable_web_page_preview=True)
 
 def process_admin_answer(message, question_id):
     if question_id not in storage.questions:
-        bot.send_message(ADMIN_ID, "❌ Вопрос не найден")
+        outbox.send(message.chat.id, "❌ Вопрос не найден")
         return
     
     can_answer, reason = can_answer_question(question_id)
     if not can_answer:
-        bot.send_message(ADMIN_ID, reason)
+        storage.release_claim(question_id, message.from_user.id)
+        outbox.send(message.chat.id, reason)
         return
     
     question = storage.questions[question_id]
@@ -1895,277 +3955,322 @@ def process_admin_answer(message, question_id):
         else:
             answer_text = text.strip()
     
-    try:
-        question_preview = question['text'][:300] + "..." if len(question['text']) > 300 else question['text']
-        
-        if admin_name:
-            header = f"📩 *Ответ на ваш вопрос #{question_id}:*\n\n"
-            header += f"*Вопрос:* {question_preview}\n\n"
-            header += f"*Ответ от \"{admin_name}\" (администратора):*"
-        else:
-            header = f"📩 *Ответ на ваш вопрос #{question_id}:*\n\n"
-            header += f"*Вопрос:* {question_preview}\n\n"
-            header += f"*Ответ от администрации:*"
-        
-        if message.content_type == 'text':
-            full_message = f"{header}\n\n{answer_text}"
-            bot.send_message(user_id, full_message, parse_mode='Markdown')
-        
-        # Обновляем статус вопроса
-        storage.questions[question_id]['status'] = 'answered'
-        storage.questions[question_id]['admin_response'] = answer_text
-        storage.questions[question_id]['admin_name'] = admin_name
-        storage.questions[question_id]['answer_time'] = datetime.now().strftime("%H:%M")
+    question_preview = question['text'][:300] + "..." if len(question['text']) > 300 else question['text']
+    
+    if admin_name:
+        header = f"📩 *Ответ на ваш вопрос #{question_id}:*\n\n"
+        header += f"*Вопрос:* {question_preview}\n\n"
+        header += f"*Ответ от \"{admin_name}\" (администратора):*"
+    else:
+        header = f"📩 *Ответ на ваш вопрос #{question_id}:*\n\n"
+        header += f"*Вопрос:* {question_preview}\n\n"
+        header += f"*Ответ от администрации:*"
+    
+    def record_answer(sent=None):
+        # Обновляем статус вопроса только после доставки ответа
+        storage.update_question(
+            question_id,
+            status='answered',
+            admin_response=answer_text,
+            admin_name=admin_name,
+            answer_time=datetime.now().strftime("%H:%M")
+        )
         
         storage.increment_answer_count(question_id)
         answer_count = storage.get_answer_count(question_id)
         remaining = MAX_ANSWERS_PER_QUESTION - answer_count
         
         if remaining > 0:
-            bot.send_message(ADMIN_ID, f"✅ Ответ #{question_id} отправлен {question['username']}\n\n"
-                                     f"ℹ️ Можно отправить еще {remaining} ответов на этот вопрос.")
+            outbox.send(message.chat.id, f"✅ Ответ #{question_id} отправлен {question['username']}\n\n"
+                        f"ℹ️ Можно отправить еще {remaining} ответов на этот вопрос.")
         else:
-            bot.send_message(ADMIN_ID, f"✅ Ответ #{question_id} отправлен {question['username']}\n\n"
-                                     f"ℹ️ Достигнут лимит ответов на этот вопрос ({MAX_ANSWERS_PER_QUESTION}).")
-        
-    except Exception as e:
-        bot.send_message(ADMIN_ID, f"❌ Ошибка отправки: {str(e)}")
+            outbox.send(message.chat.id, f"✅ Ответ #{question_id} отправлен {question['username']}\n\n"
+                        f"ℹ️ Достигнут лимит ответов на этот вопрос ({MAX_ANSWERS_PER_QUESTION}).")
+    
+    def answer_failed(e):
+        # Ответ не доставлен: вопрос снова может взять любой админ
+        storage.release_claim(question_id, message.from_user.id)
+        outbox.send(message.chat.id, f"❌ Ошибка отправки: {str(e)}")
     
-    storage.save_data()
+    if message.content_type == 'text':
+        full_message = f"{header}\n\n{answer_text}"
+        outbox.send(
+            user_id,
+            full_message,
+            parse_mode='Markdown',
+            on_sent=record_answer,
+            on_error=answer_failed
+        )
+    else:
+        record_answer()
 
 # ===== CALLBACK ОБРАБОТЧИК =====
+def begin_reply(call, replier_id, reply_to_text, target_user_id=None):
+    """Ставит ожидание ответа после нажатия кнопки «Ответить»"""
+    storage.set_pending_reply(replier_id, 0, reply_to_text, target_user_id=target_user_id)
+    
+    outbox.send(
+        replier_id,
+        f"💬 *Вы отвечаете на сообщение:*\n"
+        f"{escape_markdown(reply_to_text)}\n\n"
+        f"Введите ваш ответ:",
+        parse_mode='Markdown'
+    )
+    bot.answer_callback_query(call.id, "✏️ Введите ответ...")
+
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callbacks(call):
-    if call.data.startswith('view_violation_'):
-        user_id = int(call.data.replace('view_violation_', ''))
-        show_full_violation_message(ADMIN_ID, user_id)
-        bot.answer_callback_query(call.id, "Показываю полное сообщение...")
-        return
-    
-    elif call.data.startswith('accept_chat_'):
-        question_id = int(call.data.replace('accept_chat_', ''))
-        
-        if question_id not in storage.questions:
-            bot.answer_callback_query(call.id, "❌ Запрос устарел")
-            return
-        
-        question = storage.questions[question_id]
-        user_id = question['user_id']
-        
-        # Проверяем, не обработан ли уже этот запрос
-        if question.get('status') != 'pending':
-            bot.answer_callback_query(call.id, "❌ Этот запрос уже был обработан")
+    if call.data.startswith(CallbackRegistry.PREFIX):
+        # Кнопки с токеном: данные лежат в реестре
+        payload = callback_registry.resolve(call.data)
+        if payload is None or payload['action'] not in token_actions:
+            bot.answer_callback_query(call.id, "⌛ Кнопка устарела")
             return
         
-        storage.questions[question_id]['status'] = 'accepted'
-        storage.save_data()
-        
-        msg = bot.send_message(
-            ADMIN_ID,
-            f"💬 *Принят запрос на переписку*\n\n"
-            f"👤 Пользователь: {question['username']}\n"
-            f"🆔 ID: `{user_id}`\n\n"
-            f"📝 *Как вас звать в этой переписке?*\n"
-            f"(Напишите /cancel для отмены)",
-            parse_mode='Markdown'
-        )
-        
-        bot.register_next_step_handler(msg, ask_admin_name_step, user_id, question_id)
-        bot.answer_callback_query(call.id, "✅ Запрос принят")
+        fields = {key: value for key, value in payload.items() if key not in ('action', 'expires')}
+        token_actions.call(payload['action'], call, **fields)
         return
     
-    elif call.data.startswith('reject_chat_'):
-        question_id = int(call.data.replace('reject_chat_', ''))
-        
-        if question_id not in storage.questions:
-            bot.answer_callback_query(call.id, "❌ Запрос устарел")
-            return
-        
-        question = storage.questions[question_id]
-        user_id = question['user_id']
-        
-        # Проверяем, не обработан ли уже этот запрос
-        if question.get('status') != 'pending':
-            bot.answer_callback_query(call.id, "❌ Этот запрос уже был обработан")
-            return
-        
-        storage.questions[question_id]['status'] = 'rejected'
-        storage.save_data()
-        
-        bot.answer_callback_query(call.id, "❌ Запрос отклонен")
-        
-        try:
-            bot.send_message(
-                user_id,
-                "❌ *Администратор отклонил ваш запрос на переписку.*\n\n"
-                "Попробуйте задать вопрос через раздел 📨 Задать вопрос."
-            )
-        except:
-            pass
+    if not callback_router.dispatch(call.data, call):
+        bot.answer_callback_query(call.id, "❌ Неизвестная кнопка")
+
+@callback_router.route('view_violation', int)
+def callback_view_violation(call, user_id):
+    show_full_violation_message(call.from_user.id, user_id)
+    bot.answer_callback_query(call.id, "Показываю полное сообщение...")
+
+def take_chat_request(call, question_id):
+    """Проверяет и захватывает запрос переписки; возвращает вопрос или None"""
+    if question_id not in storage.questions:
+        bot.answer_callback_query(call.id, "❌ Запрос устарел")
+        return None
+    
+    question = storage.questions[question_id]
+    
+    # Проверяем, не обработан ли уже этот запрос
+    if question.get('status') != 'pending':
+        bot.answer_callback_query(call.id, "❌ Этот запрос уже был обработан")
+        return None
+    
+    if not storage.claim_question(question_id, call.from_user.id):
+        bot.answer_callback_query(call.id, "🔒 Запрос уже взял другой администратор")
+        return None
+    
+    return question
+
+@callback_router.route('accept_chat', int)
+def callback_accept_chat(call, question_id):
+    admin_id = call.from_user.id
+    question = take_chat_request(call, question_id)
+    if question is None:
         return
+    user_id = question['user_id']
     
-    elif call.data.startswith('reply_to_msg_'):
-        # Кнопка "Ответить" от админа к пользователю
-        parts = call.data.replace('reply_to_msg_', '').split('_', 1)
-        if len(parts) == 2:
-            user_id_str = parts[0]
-            reply_to_text = parts[1]
-            
-            if user_id_str.isdigit():
-                user_id = int(user_id_str)
-                
-                # Устанавливаем ожидание ответа
-                storage.set_pending_reply(ADMIN_ID, 0, reply_to_text)
-                
-                bot.send_message(
-                    ADMIN_ID,
-                    f"💬 *Вы отвечаете на сообщение:*\n"
-                    f"{reply_to_text}\n\n"
-                    f"Введите ваш ответ:",
-                    parse_mode='Markdown'
-                )
-                bot.answer_callback_query(call.id, "✏️ Введите ответ...")
+    storage.update_question(question_id, status='accepted')
+    
+    outbox.send(
+        admin_id,
+        f"💬 *Принят запрос на переписку*\n\n"
+        f"👤 Пользователь: {question['username']}\n"
+        f"🆔 ID: `{user_id}`\n\n"
+        f"📝 *Как вас звать в этой переписке?*\n"
+        f"(Напишите /cancel для отмены)",
+        parse_mode='Markdown'
+    )
+    
+    bot.register_next_step_handler_by_chat_id(admin_id, ask_admin_name_step, user_id, question_id)
+    bot.answer_callback_query(call.id, "✅ Запрос принят")
+
+@callback_router.route('reject_chat', int)
+def callback_reject_chat(call, question_id):
+    question = take_chat_request(call, question_id)
+    if question is None:
         return
     
-    elif call.data.startswith('reply_to_msg_admin_'):
-        # Кнопка "Ответить" от пользователя к админу
-        reply_to_text = call.data.replace('reply_to_msg_admin_', '').replace('_', ' ')
-        
-        # Находим активный чат пользователя
-        user_id = call.from_user.id
-        if is_user_in_chat(user_id):
-            # Устанавливаем ожидание ответа
-            storage.set_pending_reply(user_id, 0, reply_to_text)
-            
-            bot.send_message(
-                user_id,
-                f"💬 *Вы отвечаете на сообщение:*\n"
-                f"{reply_to_text}\n\n"
-                f"Введите ваш ответ:",
-                parse_mode='Markdown'
-            )
-            bot.answer_callback_query(call.id, "✏️ Введите ответ...")
+    storage.update_question(question_id, status='rejected')
+    
+    bot.answer_callback_query(call.id, "❌ Запрос отклонен")
+    
+    outbox.send(
+        question['user_id'],
+        "❌ *Администратор отклонил ваш запрос на переписку.*\n\n"
+        "Попробуйте задать вопрос через раздел 📨 Задать вопрос."
+    )
+
+@token_actions.route('reply_to_user')
+def callback_reply_to_user(call, user_id, text):
+    # Кнопка "Ответить" от админа к пользователю (токен реестра)
+    begin_reply(call, call.from_user.id, text, target_user_id=user_id)
+
+@token_actions.route('reply_to_admin')
+def callback_reply_to_admin(call, text):
+    # Кнопка "Ответить" от пользователя к админу (токен реестра)
+    if is_user_in_chat(call.from_user.id):
+        begin_reply(call, call.from_user.id, text)
+
+@callback_router.route('reply_to_msg', int, str)
+def callback_reply_to_msg(call, user_id, reply_to_text):
+    # Кнопка старого формата (текст в callback_data) от админа к пользователю
+    begin_reply(call, call.from_user.id, reply_to_text, target_user_id=user_id)
+
+@callback_router.route('reply_to_msg_admin', str)
+def callback_reply_to_msg_admin(call, reply_to_text):
+    # Кнопка старого формата от пользователя к админу
+    if is_user_in_chat(call.from_user.id):
+        begin_reply(call, call.from_user.id, reply_to_text)
+
+def question_author(call, question_id):
+    """user_id автора вопроса или None с ответом на нажатие"""
+    if question_id not in storage.questions:
+        bot.answer_callback_query(call.id, "❌ Вопрос не найден")
+        return None
+    return storage.questions[question_id]['user_id']
+
+@callback_router.route('ban', int)
+def callback_ban_question(call, question_id):
+    user_id = question_author(call, question_id)
+    if user_id is not None:
+        callback_ban_user(call, user_id)
+
+@callback_router.route('ban_user', int)
+def callback_ban_user(call, user_id):
+    admin_id = call.from_user.id
+    
+    outbox.send(
+        admin_id,
+        f"🚫 *Блокировка пользователя*\n\n"
+        f"ID: `{user_id}`\n\n"
+        f"Введите время и причину бана:\n"
+        f"Примеры:\n"
+        f"• `1d спам` - на 1 день за спам\n"
+        f"• `1w нарушение правил` - на 1 неделю\n"
+        f"• `нарушение` - навсегда\n\n"
+        f"Или нажмите /cancel для отмены",
+        parse_mode='Markdown'
+    )
+    
+    bot.register_next_step_handler_by_chat_id(admin_id, process_ban_with_reason, user_id)
+    bot.answer_callback_query(call.id, "📝 Введите данные...")
+
+@callback_router.route('mute', int)
+def callback_mute_question(call, question_id):
+    user_id = question_author(call, question_id)
+    if user_id is not None:
+        callback_mute_user(call, user_id)
+
+@callback_router.route('mute_user', int)
+def callback_mute_user(call, user_id):
+    admin_id = call.from_user.id
+    
+    outbox.send(
+        admin_id,
+        f"🔇 *Заглушение пользователя*\n\n"
+        f"ID: `{user_id}`\n\n"
+        f"Введите время и причину мута:\n"
+        f"Примеры:\n"
+        f"• `1h флуд` - на 1 час за флуд\n"
+        f"• `2d нарушение правил` - на 2 дня\n"
+        f"• `нарушение` - навсегда\n\n"
+        f"Или нажмите /cancel для отмены",
+        parse_mode='Markdown'
+    )
+    
+    bot.register_next_step_handler_by_chat_id(admin_id, process_mute_with_reason, user_id)
+    bot.answer_callback_query(call.id, "📝 Введите данные...")
+
+@callback_router.route('answer', int)
+def callback_answer(call, question_id):
+    admin_id = call.from_user.id
+    
+    if question_id not in storage.questions:
+        bot.answer_callback_query(call.id, "❌ Вопрос не найден")
         return
     
-    elif call.data.startswith('ban_') or call.data.startswith('ban_user_'):
-        if call.data.startswith('ban_'):
-            question_id = int(call.data.replace('ban_', ''))
-            if question_id not in storage.questions:
-                bot.answer_callback_query(call.id, "❌ Вопрос не найден")
-                return
-            user_id = storage.questions[question_id]['user_id']
-        else:
-            user_id = int(call.data.replace('ban_user_', ''))
-        
-        msg = bot.send_message(
-            ADMIN_ID,
-            f"🚫 *Блокировка пользователя*\n\n"
-            f"ID: `{user_id}`\n\n"
-            f"Введите время и причину бана:\n"
-            f"Примеры:\n"
-            f"• `1d спам` - на 1 день за спам\n"
-            f"• `1w нарушение правил` - на 1 неделю\n"
-            f"• `нарушение` - навсегда\n\n"
-            f"Или нажмите /cancel для отмены",
-            parse_mode='Markdown'
-        )
-        
-        bot.register_next_step_handler(msg, process_ban_with_reason, user_id)
-        bot.answer_callback_query(call.id, "📝 Введите данные...")
+    can_answer, reason = can_answer_question(question_id)
+    if not can_answer:
+        bot.answer_callback_query(call.id, reason)
+        return
     
-    elif call.data.startswith('mute_') or call.data.startswith('mute_user_'):
-        if call.data.startswith('mute_'):
-            question_id = int(call.data.replace('mute_', ''))
-            if question_id not in storage.questions:
-                bot.answer_callback_query(call.id, "❌ Вопрос не найден")
-                return
-            user_id = storage.questions[question_id]['user_id']
-        else:
-            user_id = int(call.data.replace('mute_user_', ''))
-        
-        msg = bot.send_message(
-            ADMIN_ID,
-            f"🔇 *Заглушение пользователя*\n\n"
-            f"ID: `{user_id}`\n\n"
-            f"Введите время и причину мута:\n"
-            f"Примеры:\n"
-            f"• `1h флуд` - на 1 час за флуд\n"
-            f"• `2d нарушение правил` - на 2 дня\n"
-            f"• `нарушение` - навсегда\n\n"
-            f"Или нажмите /cancel для отмены",
-            parse_mode='Markdown'
-        )
-        
-        bot.register_next_step_handler(msg, process_mute_with_reason, user_id)
-        bot.answer_callback_query(call.id, "📝 Введите данные...")
+    if not storage.claim_question(question_id, admin_id):
+        bot.answer_callback_query(call.id, "🔒 На вопрос уже отвечает другой администратор")
+        return
     
-    elif call.data.startswith('answer_'):
-        question_id = int(call.data.replace('answer_', ''))
-        
-        if question_id not in storage.questions:
-            bot.answer_callback_query(call.id, "❌ Вопрос не найден")
-            return
-        
-        can_answer, reason = can_answer_question(question_id)
-        if not can_answer:
-            bot.answer_callback_query(call.id, reason)
-            return
-        
-        question = storage.questions[question_id]
-        
-        storage.admin_pending_answers[ADMIN_ID] = question_id
-        
-        msg = bot.send_message(
-            ADMIN_ID,
-            f"✏️ *Ответ на вопрос #{question_id}*\n\n"
-            f"👤 От: {question['username']} (`{question['user_id']}`)\n"
-            f"⏰ {question['time']} | {question['date']}\n"
-            f"💬 Вопрос: {question.get('masked_text', question['text'])[:200]}...\n\n"
-            f"*Введите ответ (только текст):*\n"
-            f"Используйте [Имя Фамилия] в начале для подписи\n"
-            f"Пример: `[Алексей Петров] Ответ...`\n\n"
-            f"ℹ️ *Если нужно посмотреть полный текст со ссылками, используйте [/full#{question_id}](#full_{question_id})*",
-            parse_mode='Markdown'
-        )
-        
-        bot.answer_callback_query(call.id, "✏️ Введите ответ...")
+    question = storage.questions[question_id]
+    
+    previous_id = storage.admin_pending_answers.get(admin_id)
+    if previous_id is not None and previous_id != question_id:
+        # Админ переключился на другой вопрос: прежний снова может взять любой админ
+        storage.release_claim(previous_id, admin_id)
+    
+    storage.admin_pending_answers[admin_id] = question_id
+    storage.save_item('admin_pending_answers', admin_id)
+    
+    outbox.send(
+        admin_id,
+        f"✏️ *Ответ на вопрос #{question_id}*\n\n"
+        f"👤 От: {question['username']} (`{question['user_id']}`)\n"
+        f"⏰ {question['time']} | {question['date']}\n"
+        f"💬 Вопрос: {question.get('masked_text', question['text'])[:200]}...\n\n"
+        f"*Введите ответ (только текст):*\n"
+        f"Используйте [Имя Фамилия] в начале для подписи\n"
+        f"Пример: `[Алексей Петров] Ответ...`\n\n"
+        f"ℹ️ *Если нужно посмотреть полный текст со ссылками, используйте [/full#{question_id}](#full_{question_id})*",
+        parse_mode='Markdown'
+    )
     
-    elif call.data.startswith('full_'):
-        question_id = int(call.data.replace('full_', ''))
-        show_full_question_text(ADMIN_ID, question_id)
+    bot.answer_callback_query(call.id, "✏️ Введите ответ...")
+
+@callback_router.route('full', int)
+def callback_full(call, question_id):
+    show_full_question_text(call.from_user.id, question_id)
+    bot.answer_callback_query(call.id)
+
+@callback_router.route('tasks_page', int, str)
+def callback_tasks_page(call, page, task_filter):
+    if task_filter not in TASK_FILTERS:
+        task_filter = 'all'
+    
+    text, markup = render_tasks_page(page, task_filter)
+    outbox.edit(call.message.chat.id, call.message.message_id, text, parse_mode='Markdown',
+                reply_markup=markup, disable_web_page_preview=True)
+    bot.answer_callback_query(call.id)
+
+@callback_router.route('task_open', int)
+def callback_task_open(call, question_id):
+    if storage.questions.get(question_id, {}).get('status') != 'pending':
+        bot.answer_callback_query(call.id, "❌ Этот вопрос уже обработан")
+        return
+    
+    try:
+        show_task_card(call.from_user.id, question_id)
+    finally:
+        # Иначе у админа так и крутятся «часики» на кнопке
         bot.answer_callback_query(call.id)
 
 def ask_admin_name_step(message, user_id, question_id):
     if message.text == '/cancel':
-        bot.send_message(ADMIN_ID, "❌ Создание чата отменено.")
+        outbox.send(message.chat.id, "❌ Создание чата отменено.")
         
-        try:
-            bot.send_message(
-                user_id,
-                "❌ *Во время составления правил для переписки, администратор передумал и отклонил ваш запрос.*"
-            )
-        except:
-            pass
+        outbox.send(
+            user_id,
+            "❌ *Во время составления правил для переписки, администратор передумал и отклонил ваш запрос.*"
+        )
         
         if question_id in storage.questions:
-            storage.questions[question_id]['status'] = 'rejected'
-            storage.save_data()
+            storage.update_question(question_id, status='rejected')
         
         return
     
     admin_name = message.text.strip()[:30]
     
     if not admin_name:
-        bot.send_message(ADMIN_ID, "❌ Имя не может быть пустым.")
+        outbox.send(message.chat.id, "❌ Имя не может быть пустым.")
         return
     
-    if user_id not in storage.active_chats:
-        storage.active_chats[user_id] = {}
+    storage.update_active_chat(user_id, admin_name=admin_name)
     
-    storage.active_chats[user_id]['admin_name'] = admin_name
-    
-    msg = bot.send_message(
-        ADMIN_ID,
+    outbox.send(
+        message.chat.id,
         f"✅ Имя сохранено: *{admin_name}*\n\n"
         f"*Разрешить отправку ссылок?*\n\n"
         f"Напишите `Да` или `Нет` (регистр не важен).\n"
@@ -2175,23 +4280,19 @@ def ask_admin_name_step(message, user_id, question_id):
         parse_mode='Markdown'
     )
     
-    bot.register_next_step_handler(msg, ask_links_step, user_id, question_id)
+    bot.register_next_step_handler_by_chat_id(message.chat.id, ask_links_step, user_id, question_id)
 
 def ask_links_step(message, user_id, question_id):
     if message.text == '/cancel':
-        bot.send_message(ADMIN_ID, "❌ Создание чата отменено.")
+        outbox.send(message.chat.id, "❌ Создание чата отменено.")
         
-        try:
-            bot.send_message(
-                user_id,
-                "❌ *Во время составления правил для переписки, администратор передумал и отклонил ваш запрос.*"
-            )
-        except:
-            pass
+        outbox.send(
+            user_id,
+            "❌ *Во время составления правил для переписки, администратор передумал и отклонил ваш запрос.*"
+        )
         
         if question_id in storage.questions:
-            storage.questions[question_id]['status'] = 'rejected'
-            storage.save_data()
+            storage.update_question(question_id, status='rejected')
         
         return
     
@@ -2208,8 +4309,8 @@ def ask_links_step(message, user_id, question_id):
         storage.chat_settings[user_id] = {}
     storage.chat_settings[user_id]['allow_links'] = allow_links
     
-    msg = bot.send_message(
-        ADMIN_ID,
+    outbox.send(
+        message.chat.id,
         f"✅ {'Ссылки разрешены' if allow_links else 'Ссылки запрещены'}\n\n"
         f"📝 *Какой лимит символов установим на одно сообщение?*\n\n"
         f"• Минимум: 15 символов\n"
@@ -2219,23 +4320,19 @@ def ask_links_step(message, user_id, question_id):
         parse_mode='Markdown'
     )
     
-    bot.register_next_step_handler(msg, ask_chat_limit_step, user_id, question_id, allow_links)
+    bot.register_next_step_handler_by_chat_id(message.chat.id, ask_chat_limit_step, user_id, question_id, allow_links)
 
 def ask_chat_limit_step(message, user_id, question_id, allow_links):
     if message.text == '/cancel':
-        bot.send_message(ADMIN_ID, "❌ Создание чата отменено.")
+        outbox.send(message.chat.id, "❌ Создание чата отменено.")
         
-        try:
-            bot.send_message(
-                user_id,
-                "❌ *Во время составления правил для переписки, администратор передумал и отклонил ваш запрос.*"
-            )
-        except:
-            pass
+        outbox.send(
+            user_id,
+            "❌ *Во время составления правил для переписки, администратор передумал и отклонил ваш запрос.*"
+        )
         
         if question_id in storage.questions:
-            storage.questions[question_id]['status'] = 'rejected'
-            storage.save_data()
+            storage.update_question(question_id, status='rejected')
         
         return
     
@@ -2254,18 +4351,19 @@ def ask_chat_limit_step(message, user_id, question_id, allow_links):
     
     storage.chat_limits[user_id] = limit
     
-    complete_chat_setup(user_id, question_id, confirmation, allow_links, limit)
+    complete_chat_setup(message.chat.id, user_id, question_id, confirmation, allow_links, limit)
 
-def complete_chat_setup(user_id, question_id, confirmation, allow_links, limit):
+def complete_chat_setup(admin_id, user_id, question_id, confirmation, allow_links, limit):
     """Завершает настройку чата"""
-    storage.active_chats[user_id].update({
-        'admin_id': ADMIN_ID,
-        'user_name': storage.questions[question_id]['username'],
-        'start_time': datetime.now().isoformat(),
-        'question_id': question_id
-    })
+    storage.update_active_chat(
+        user_id,
+        admin_id=admin_id,
+        user_name=storage.questions[question_id]['username'],
+        start_time=datetime.now().isoformat(),
+        question_id=question_id
+    )
     
-    bot.send_message(
+    outbox.send(
         user_id,
         f"💬 *Переписка начата!*\n\n"
         f"👨‍💼 Администратор: *{storage.active_chats[user_id]['admin_name']}*\n"
@@ -2279,8 +4377,8 @@ def complete_chat_setup(user_id, question_id, confirmation, allow_links, limit):
         parse_mode='Markdown'
     )
     
-    bot.send_message(
-        ADMIN_ID,
+    outbox.send(
+        admin_id,
         f"💬 *Чат начат!*\n\n"
         f"{confirmation}\n"
         f"🔗 Ссылки: {'✅ Разрешены' if allow_links else '❌ Запрещены'}\n\n"
@@ -2289,14 +4387,16 @@ def complete_chat_setup(user_id, question_id, confirmation, allow_links, limit):
         f"💭 Теперь все ваши сообщения будут пересылаться.\n"
         f"💬 *Под каждым сообщением есть кнопка 'Ответить'*\n"
         f"⏹ Используйте /stop для завершения.",
-        parse_mode='Markdown'
+        parse_mode='Markdown',
+        on_sent=lambda sent: reply_routes.add(admin_id, sent.message_id, user_id)
     )
     
-    storage.save_data()
+    storage.save_item('chat_settings', user_id)
+    storage.save_item('chat_limits', user_id)
 
 def process_ban_with_reason(message, user_id):
     if message.text == '/cancel':
-        bot.send_message(ADMIN_ID, "❌ Блокировка отменена.")
+        outbox.send(message.chat.id, "❌ Блокировка отменена.")
         return
     
     text = message.text.strip()
@@ -2329,7 +4429,7 @@ def process_ban_with_reason(message, user_id):
     
     duration_text = "навсегда" if duration_seconds == 0 else format_duration(duration_seconds)
     username = storage.user_profiles.get(user_id, {}).get('username', f'ID: {user_id}')
-    bot.send_message(ADMIN_ID, f"🚫 Пользователь `{user_id}` ({username}) забанен на {duration_text}.\nПричина: {reason}")
+    outbox.send(message.chat.id, f"🚫 Пользователь `{user_id}` ({username}) забанен на {duration_text}.\nПричина: {reason}")
     
     try:
         if duration_seconds == 0:
@@ -2337,7 +4437,7 @@ def process_ban_with_reason(message, user_id):
         else:
             ban_time = format_duration(duration_seconds)
         
-        bot.send_message(
+        outbox.send(
             user_id,
             f"🚫 Вы были заблокированы администратором.\n"
             f"Причина: {reason}\n"
@@ -2345,12 +4445,10 @@ def process_ban_with_reason(message, user_id):
         )
     except:
         pass
-    
-    storage.save_data()
 
 def process_mute_with_reason(message, user_id):
     if message.text == '/cancel':
-        bot.send_message(ADMIN_ID, "❌ Заглушение отменено.")
+        outbox.send(message.chat.id, "❌ Заглушение отменено.")
         return
     
     text = message.text.strip()
@@ -2377,7 +4475,7 @@ def process_mute_with_reason(message, user_id):
     
     duration_text = "навсегда" if duration_seconds == 0 else format_duration(duration_seconds)
     username = storage.user_profiles.get(user_id, {}).get('username', f'ID: {user_id}')
-    bot.send_message(ADMIN_ID, f"🔇 Пользователь `{user_id}` ({username}) заглушен на {duration_text}.\nПричина: {reason}")
+    outbox.send(message.chat.id, f"🔇 Пользователь `{user_id}` ({username}) заглушен на {duration_text}.\nПричина: {reason}")
     
     try:
         if duration_seconds == 0:
@@ -2385,7 +4483,7 @@ def process_mute_with_reason(message, user_id):
         else:
             mute_time = format_duration(duration_seconds)
         
-        bot.send_message(
+        outbox.send(
             user_id,
             f"🔇 Вы были заглушены администратором.\n\n"
             f"⚠️ *Вам запрещено использовать прямую переписку.*\n\n"
@@ -2395,39 +4493,382 @@ def process_mute_with_reason(message, user_id):
         )
     except:
         pass
+
+# ===== РЕЖИМЫ ЗАПУСКА =====
+def update_user_id(update):
+    """Возвращает id пользователя, от которого пришло обновление"""
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        event = getattr(update, kind, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    return None
+
+def install_sigterm_handler():
+    """На SIGTERM дописывает журнал и очередь отправки, затем останавливает бота как по Ctrl+C"""
+    def handle_sigterm(signum, frame):
+        outbox.drain()  # Отправленные сообщения могут обновить хранилище
+        storage.flush()
+        raise KeyboardInterrupt
+    
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+class AsyncRuntime:
+    """asyncio-режим: обновления разных пользователей обрабатываются параллельно,
+    обновления одного пользователя - строго по порядку.
+    
+    Обработчики остаются синхронными и выполняются в пуле потоков.
+    """
+    
+    def __init__(self, bot, workers=ASYNC_WORKERS):
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._user_locks = {}  # {user_id: [asyncio.Lock, обновлений в работе]}
+    
+    async def dispatch(self, update):
+        user_id = update_user_id(update)
+        entry = self._user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        
+        try:
+            # asyncio.Lock отдаёт блокировку в порядке очереди - порядок обновлений сохраняется
+            async with entry[0]:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.bot.process_new_updates, [update])
+        except Exception as e:
+            print(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+    
+    async def poll(self):
+        loop = asyncio.get_running_loop()
+        get_updates = functools.partial(self.bot.get_updates, timeout=20, long_polling_timeout=20)
+        offset = None
+        in_flight = set()
+        
+        while True:
+            try:
+                updates = await loop.run_in_executor(None, functools.partial(get_updates, offset=offset))
+            except Exception as e:
+                print(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(3)
+                continue
+            
+            for update in updates:
+                offset = update.update_id + 1
+                task = asyncio.create_task(self.dispatch(update))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+    
+    def run(self):
+        # Обработчики вызываются прямо в потоках пула, без собственного пула telebot
+        self.bot.threaded = False
+        asyncio.run(self.poll())
+
+class ShardedDispatcher:
+    """Распределяет обновления по потокам-шардам по id пользователя.
+    
+    Разные пользователи обрабатываются параллельно, обновления одного
+    пользователя всегда попадают в один поток и идут по порядку.
+    """
+    
+    def __init__(self, bot, shards=HANDLER_SHARDS, queue_size=0):
+        self.bot = bot
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.threads = [
+            threading.Thread(target=self._worker, args=(updates,), daemon=True)
+            for updates in self.queues
+        ]
+        # Обработчики вызываются прямо в потоке шарда, без собственного пула telebot
+        self.bot.threaded = False
+        for thread in self.threads:
+            thread.start()
+    
+    def dispatch(self, update, block=True):
+        """Ставит обновление в очередь его шарда; False, если очередь переполнена"""
+        shard = self.queues[hash(update_user_id(update)) % len(self.queues)]
+        try:
+            shard.put(update, block=block)
+        except queue.Full:
+            return False
+        return True
+    
+    def _worker(self, updates):
+        while True:
+            update = updates.get()
+            try:
+                if update is None:
+                    return
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                print(f"Ошибка обработки обновления: {e}")
+            finally:
+                updates.task_done()
+    
+    def stop(self):
+        """Дожидается обработки уже принятых обновлений и останавливает потоки"""
+        for updates in self.queues:
+            updates.put(None)
+        for thread in self.threads:
+            thread.join()
+    
+    def poll(self):
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = self.bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20)
+                except Exception as e:
+                    print(f"Ошибка получения обновлений: {e}")
+                    time.sleep(3)
+                    continue
+                
+                for update in updates:
+                    offset = update.update_id + 1
+                    self.dispatch(update)
+        except KeyboardInterrupt:
+            self.stop()
+
+class WebhookServer:
+    """Приём обновлений через webhook вместо long polling.
+    
+    Встроенный HTTP-сервер передаёт обновления в ShardedDispatcher с
+    ограниченными очередями; при переполнении отвечает 503, и Telegram
+    повторяет доставку позже.
+    Без WEBHOOK_SECRET секрет генерируется и передаётся в set_webhook;
+    если webhook настроен вручную (нет WEBHOOK_URL), сервер без секрета
+    не запускается - иначе любой мог бы прислать поддельное обновление.
+    Локально можно отправить записанное обновление:
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -d @update.json http://127.0.0.1:8443/webhook
+    """
+    
+    def __init__(self, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE):
+        if not secret:
+            if not WEBHOOK_URL:
+                raise RuntimeError("для webhook без WEBHOOK_URL нужен WEBHOOK_SECRET")
+            secret = secrets.token_urlsafe(32)
+        
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.queue_size = queue_size
+        self.dispatcher = None
+        self.received = 0
+        self.rejected = 0
+        self._stopping = threading.Event()
+        self._in_flight = 0  # Запросы, прошедшие проверку остановки и ещё не отдавшие обновление
+        self._idle = threading.Condition()
+        
+        webhook = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            timeout = 10  # Медленный клиент не задерживает остановку дольше этого
+            
+            def do_POST(self):
+                webhook._handle_post(self)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+    
+    def _handle_post(self, request):
+        if request.path != self.path:
+            request.send_error(404)
+            return
+        
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.secret.encode('utf-8')):
+            request.send_error(403)
+            return
+        
+        # Проверка и учёт - под одной блокировкой: shutdown не остановит
+        # диспетчер, пока принятый запрос не передал ему обновление
+        with self._idle:
+            stopping = self._stopping.is_set()
+            if not stopping:
+                self._in_flight += 1
+        if stopping:
+            request.send_error(503)
+            return
+        
+        try:
+            self._accept_update(request)
+        finally:
+            with self._idle:
+                self._in_flight -= 1
+                self._idle.notify_all()
+    
+    def _accept_update(self, request):
+        try:
+            length = int(request.headers.get('Content-Length', 0))
+            update = types.Update.de_json(request.rfile.read(length).decode('utf-8'))
+        except Exception:
+            request.send_error(400)
+            return
+        
+        if not self.dispatcher.dispatch(update, block=False):
+            with self._idle:
+                self.rejected += 1
+            request.send_error(503)
+            return
+        
+        with self._idle:
+            self.received += 1
+        request.send_response(200)
+        request.end_headers()
+    
+    def serve(self):
+        if WEBHOOK_URL:
+            self.bot.remove_webhook()
+            self.bot.set_webhook(url=WEBHOOK_URL + self.path, secret_token=self.secret)
+        
+        self.dispatcher = ShardedDispatcher(self.bot, queue_size=max(1, self.queue_size // HANDLER_SHARDS))
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print(f"🌐 Webhook слушает {self.httpd.server_address[0]}:{self.httpd.server_address[1]}{self.path}")
+        
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop.set())
+        while not stop.wait(1):
+            pass
+        
+        self.shutdown()
+        print(f"🌐 Webhook остановлен: принято {self.received}, отклонено {self.rejected}")
+    
+    def shutdown(self):
+        """Перестаёт принимать обновления и дожидается обработки уже принятых"""
+        with self._idle:
+            self._stopping.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        # Потоки ThreadingHTTPServer - демоны, server_close их не ждёт
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight == 0)
+        self.dispatcher.stop()
+
+def benchmark_webhook(count=5000, clients=8):
+    """Сравнивает приём записанных обновлений через webhook и через пачки getUpdates"""
+    payloads = [
+        json.dumps({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': f'сообщение {update_id}',
+                'chat': {'id': 1000 + update_id % 1000, 'type': 'private'},
+                'from': {'id': 1000 + update_id % 1000, 'is_bot': False, 'first_name': 'u'}
+            }
+        }, ensure_ascii=False).encode('utf-8')
+        for update_id in range(count)
+    ]
     
-    storage.save_data()
+    def counting_bot():
+        # Отдельный бот без обработчиков проекта: замеряется только приём и раздача обновлений
+        bench_bot = telebot.TeleBot('0:bench')
+        processed = []
+        bench_bot.message_handler(func=lambda message: True)(lambda message: processed.append(1))
+        return bench_bot, processed
+    
+    print(f"📬 Обновлений: {count}, шардов: {HANDLER_SHARDS}")
+    
+    # Polling: разбор ответов getUpdates пачками по 100, без сетевой задержки Telegram
+    bench_bot, processed = counting_bot()
+    started = time.perf_counter()
+    dispatcher = ShardedDispatcher(bench_bot)
+    for offset in range(0, count, 100):
+        response = b'[' + b','.join(payloads[offset:offset + 100]) + b']'
+        for raw in json.loads(response):
+            dispatcher.dispatch(types.Update.de_json(json.dumps(raw)))
+    dispatcher.stop()
+    elapsed = time.perf_counter() - started
+    print(f"   polling (без сети): {len(processed) / elapsed:8,.0f} обновлений/с")
+    
+    # Webhook: клиенты присылают обновления POST-запросами, на 503 повторяют
+    bench_bot, processed = counting_bot()
+    server = WebhookServer(bench_bot, host='127.0.0.1', port=0, secret='bench')
+    server.dispatcher = ShardedDispatcher(bench_bot, queue_size=max(1, server.queue_size // HANDLER_SHARDS))
+    threading.Thread(target=server.httpd.serve_forever, daemon=True).start()
+    host, port = server.httpd.server_address[:2]
+    
+    def post(body):
+        while True:
+            connection = http.client.HTTPConnection(host, port)
+            connection.request('POST', server.path, body, {'X-Telegram-Bot-Api-Secret-Token': 'bench',
+                                                           'Content-Type': 'application/json'})
+            status = connection.getresponse().status
+            connection.close()
+            if status != 503:
+                return status
+            time.sleep(0.01)
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        statuses = list(pool.map(post, payloads))
+    server.shutdown()
+    elapsed = time.perf_counter() - started
+    print(f"   webhook ({clients} клиентов): {len(processed) / elapsed:8,.0f} обновлений/с | "
+          f"ответов 200: {statuses.count(200)}, повторов после 503: {server.rejected}")
 
 # ===== ЗАПУСК =====
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate-sqlite']:
+        migrate_to_sqlite()
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-ratelimit']:
+        benchmark_rate_limiter(*[int(arg) for arg in sys.argv[2:4]])
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-webhook']:
+        benchmark_webhook(*[int(arg) for arg in sys.argv[2:4]])
+        sys.exit(0)
+    if sys.argv[1:2] == ['fake-api']:
+        FakeBotAPI('127.0.0.1', *[int(arg) for arg in sys.argv[2:5]]).serve()
+        sys.exit(0)
+    if sys.argv[1:] == ['bench-urls']:
+        benchmark_urls()
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-startup']:
+        benchmark_startup([int(size) for size in sys.argv[2:]] or (10_000, 100_000, 1_000_000))
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-snapshot']:
+        benchmark_snapshot_codecs([int(size) for size in sys.argv[2:]] or (10_000, 100_000, 1_000_000))
+        sys.exit(0)
+    
+    archived = storage.archive_old_questions()
+    
     print("=" * 50)
-    print(f"🤖 Бот запущен | Админ: {ADMIN_ID}")
-    print(f"👥 Пользователей: {len(storage.user_profiles)}")
-    print(f"📨 Вопросов: {len(storage.questions)}")
-    
-    active_bans = 0
-    for user_id, ban_data in storage.banned_users.items():
-        if ban_data['until'] == 0 or time.time() < ban_data['until']:
-            active_bans += 1
-    
-    active_mutes = 0
-    for user_id, mute_data in storage.muted_users.items():
-        if mute_data['until'] == 0 or time.time() < mute_data['until']:
-            active_mutes += 1
-    
-    print(f"🚫 Активных банов: {active_bans}")
-    print(f"🔇 Активных мутов: {active_mutes}")
-    print(f"💬 Активных чатов: {len(storage.active_chats)}")
-    print(f"⚠️  Нарушений ссылок: {len(storage.violation_messages)}")
+    print(f"🤖 Бот запущен | Админы: {', '.join(map(str, ADMIN_IDS))} | Хранилище: {STORAGE_BACKEND} ({storage.snapshot_codec}) | Режим: {BOT_RUNTIME}")
+    print(f"👥 Пользователей: {storage.count_items('user_profiles')}")
+    print(f"📨 Вопросов: {len(storage.questions)} (перенесено в архив: {archived})")
+    print(f"🚫 Активных банов: {storage.count_active_bans()}")
+    print(f"🔇 Активных мутов: {storage.count_active_mutes()}")
+    print(f"💬 Активных чатов: {len(storage.active_chats)} (устаревших записей убрано: {storage.stale_sessions_removed})")
+    if storage.corrupt_lines:
+        print(f"⚠️  Пропущено повреждённых строк журнала: {storage.corrupt_lines}")
+    if storage.keys_merged:
+        print(f"🔑 Слито записей с дублирующимися id: {storage.keys_merged}")
+    print(f"⚠️  Нарушений ссылок: {storage.count_items('violation_messages')}")
     print(f"📝 Максимум активных вопросов: {storage.max_active_questions}")
     print(f"🛡️  Антиспам: {SPAM_LIMIT_MESSAGES} сообщений за {SPAM_LIMIT_SECONDS} секунд")
+    print(f"⏱ Хранилище загружено за {storage.load_time_ms} мс ({'лениво' if storage.lazy else 'полностью'}), "
+          f"с момента запуска {int((time.perf_counter() - STARTED_AT) * 1000)} мс")
     print("=" * 50)
     
-    # Запускаем поток для проверки истекших банов и мутов
-    expiration_check_thread = threading.Thread(target=check_ban_expirations, daemon=True)
-    expiration_check_thread.start()
+    # Запускаем планировщик истечения банов и мутов
+    expiry_scheduler.start()
+    # Webhook-режим ставит свой обработчик в WebhookServer.serve
+    install_sigterm_handler()
     
     try:
-        bot.polling(none_stop=True, interval=0)
+        if BOT_RUNTIME == 'asyncio':
+            AsyncRuntime(bot).run()
+        elif BOT_RUNTIME == 'sharded':
+            ShardedDispatcher(bot).poll()
+        elif BOT_RUNTIME == 'webhook':
+            WebhookServer(bot).serve()
+        else:
+            bot.polling(none_stop=True, interval=0)
+    except KeyboardInterrupt:
+        print("🛑 Бот остановлен")
     except Exception as e:
         print(f"Ошибка при запуске бота: {e}")